@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# https://github.com/clxjaguar/mk312-gui
+# Headless remote control: drives the box (or several) from the UDP remote control messages, without Qt
+
+import sys, time, signal, argparse, threading, asyncio
+from mk312core import BoxController, AsyncBoxWorker, RemoteControl, UDPServer, loadFunscript, FunscriptPlayer, MpvClock, UDPClock
+
+def main():
+	parser = argparse.ArgumentParser(description="MK-312 remote control daemon")
+	parser.add_argument('port', help="serial port, or Wi-Fi bridge address (IP for the unencrypted mode, IP:port otherwise)")
+	parser.add_argument('-a', '--level-a', type=int, default=0, help="channel A level (0-255) for a remote factor of 1")
+	parser.add_argument('-b', '--level-b', type=int, default=0, help="channel B level (0-255) for a remote factor of 1")
+	parser.add_argument('--box', metavar='PORT[@GAIN]', action='append', default=[], help="additional box, with a gain (1.0 by default)")
+	parser.add_argument('--udp-port', type=int, default=50000, help="remote control port")
+	parser.add_argument('--max-age', type=float, default=0, help="drop the remote control messages (v2) older than this (s), only if the clock of the sender is synchronised with this one (0 to keep them)")
+	parser.add_argument('--buffer', type=float, default=0.1, help="delay of the timestamped remote control messages (s), for absorbing the jitter (0 to disable)")
+	parser.add_argument('--funscript', metavar='FILE', help="play this funscript or timeline (on channel A only with --funscript-b)")
+	parser.add_argument('--funscript-b', metavar='FILE', help="funscript for channel B")
+	parser.add_argument('--mpv-socket', metavar='PATH', help="follow the position of mpv (mpv --input-ipc-server=PATH) instead of the one sent by subsync.lua")
+	parser.add_argument('--trace', metavar='FILE', help="record the traffic with the boxes in FILE (one file per box)")
+	parser.add_argument('--asyncio', action='store_true', help="drive the boxes and the UDP port from a single asyncio event loop instead of a thread each (no --trace)")
+	args = parser.parse_args()
+	if not args.level_a and not args.level_b:
+		parser.error("at least one of --level-a or --level-b is needed")
+
+	scripts = {}
+	try:
+		if args.funscript:
+			scripts['channel_a_level'] = scripts['channel_b_level'] = loadFunscript(args.funscript)
+		if args.funscript_b:
+			scripts['channel_b_level'] = loadFunscript(args.funscript_b)
+	except Exception as e:
+		parser.error("can't load the funscript: %s" % (e))
+	if args.mpv_socket and not MpvClock.supported:
+		parser.error("--mpv-socket is not supported on this system, the position can be sent by subsync.lua instead")
+	if args.asyncio and args.trace:
+		parser.error("--trace is not available with --asyncio")
+
+	controller = BoxController()
+	for i, box in enumerate([args.port] + args.box):
+		portName, gain = box.split('@') if '@' in box and i else (box, 1.0)
+		name = 'box%d' % (i+1) if i else 'main'
+		worker = controller.addBox(name, AsyncBoxWorker() if args.asyncio else None, gain=float(gain), groups=(controller.remoteGroup,), overridePots=True)
+		worker.statusUpdated.connect(lambda level, text, name=name: print("%s [%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), name, text)))
+		if args.trace:
+			worker.tracePath = args.trace if not i else "%s.%s" % (args.trace, name)
+		worker.open(portName)
+
+	remoteControl = RemoteControl(controller, controller.remoteGroup, bufferDelay=args.buffer)
+	remoteControl.setChannel('channel_a_level', args.level_a)
+	remoteControl.setChannel('channel_b_level', args.level_b)
+	udpServer = UDPServer(port=args.udp_port, maxAge=args.max_age, thread=not args.asyncio)
+	remoteControl.connect(udpServer)
+	if scripts:
+		if args.mpv_socket:
+			clock = MpvClock(args.mpv_socket)
+		else:
+			clock = UDPClock()
+			clock.connect(udpServer)
+		player = FunscriptPlayer(remoteControl, clock, scripts)
+
+	if args.asyncio:
+		asyncio.run(serveAsync(controller, udpServer))
+	else:
+		exiting = threading.Event()
+		signal.signal(signal.SIGINT, lambda signum, frame: exiting.set())
+		signal.signal(signal.SIGTERM, lambda signum, frame: exiting.set())
+		while not exiting.wait(1):
+			pass
+
+	if scripts:
+		player.stop()
+	if not args.asyncio:
+		# let the workers reset the keys and close the ports
+		controller.close()
+		deadline = time.time() + 2
+		while time.time() < deadline and any(worker.state != worker.CLOSED for name, worker in controller.boxes()):
+			time.sleep(0.05)
+	remoteControl.stop()
+	controller.stop()
+	print(controller.formatStats())
+	print()
+	print(udpServer.stats.format("Remote control statistics"))
+	print(remoteControl.stats.format("Remote control jitter buffer"))
+	sys.exit(0)
+
+async def serveAsync(controller, udpServer):
+	""" Runs the boxes (AsyncBoxWorkers) and the UDP port on the event loop until SIGINT or SIGTERM """
+	loop = asyncio.get_running_loop()
+	exiting = asyncio.Event()
+	for signum in (signal.SIGINT, signal.SIGTERM):
+		signal.signal(signum, lambda signum, frame: loop.call_soon_threadsafe(exiting.set))
+	transport = await udpServer.listenAsync()
+	tasks = [asyncio.create_task(worker.run()) for name, worker in controller.boxes()]
+	await exiting.wait()
+
+	transport.close()
+	# let the workers write the last values, reset the keys and close the ports
+	controller.stop()
+	done, pending = await asyncio.wait(tasks, timeout=2)
+	for task in pending:
+		task.cancel()
+
+if __name__ == "__main__":
+	main()
@@ -3,7 +3,7 @@
 # https://github.com/clxjaguar/mk312-gui
 
 VERSION = '0.16'
-import sys, re, time, socket, serial, serial.tools.list_ports, textwrap
+import sys, time, serial.tools.list_ports, textwrap, argparse
 
 try:
 	# sudo apt-get install python3-pyqt5
@@ -24,565 +24,24 @@ except:
 		sys.stderr.write("Please type: sudo apt install python3-qtpy\n")
 		exit()
 
-# the fcntl module seems to not to exists on windows
-try: import fcntl
-except: fcntl = None
-
-class BoxWorker(QObject):
-	CLOSED = 0
-	OPENING = 1
-	CONNECTED = 2
-	CLOSING = 3
-	EXITING = -1
-
-	modes = {0:   "None",   0x76:"Waves",  0x77:"Stroke",  0x78:"Climb",  0x79:"Combo",  0x7a:"Intense", 0x7b:"Rhythm",
-	         0x7c:"Audio1", 0x7d:"Audio2",  0x7e:"Audio3", 0x7f:"Split",  0x80:"Random1", 0x81:"Random2", 0x82:"Toggle",
-	         0x83:"Orgasm", 0x84:"Torment", 0x85:"Phase1", 0x86:"Phase2", 0x87:"Phase3",
-	         0x88:"User1",  0x89:"User2",   0x8a:"User3",  0x8b:"User4",  0x8c:"User5",   0x8d:"User6",   0x8e:"User7"}
-
-	powerlevels = {1:"Low (1)",2:"Normal (2)",3:"High (3)"}
-
-	registers = {'advparam_ramp_level': 0x41f8, 'advparam_ramp_time': 0x41f9, 'advparam_depth': 0x41fa, 'advparam_tempo': 0x41fb,
-	             'advparam_frequency': 0x41fc, 'advparam_effect': 0x41fd, 'advparam_width': 0x41fe, 'advparam_pace': 0x41ff,
-	             'current_sense': 0x4060, 'multiadjust_value': 0x4061, 'multiadjust_scaled': 0x420d,
-	             'multiadjust_min': 0x4086, 'multiadjust_max': 0x4087, 'psu_voltage': 0x4062,
-	             'battery_voltage': 0x4063, 'battery_voltage_boot': 0x4203, 'channel_a_level': 0x4064,
-	             'channel_b_level': 0x4065, 'power_level_range': 0x41f4,
-	             'user_modes_loaded': {'addr': 0x41f3, 'offset': 0x87}, 'adc_disable': {'addr': 0x400f, 'bit': 0},
-	             'box_version':0x00fc, 'v1':0x00fd, 'v2':0x00fe, 'v3':0x00ff, 'com_cipher_key':0x4213,
-	             'current_mode': 0x407b, 'channel_a_split_mode': 0x41f5, 'channel_b_split_mode': 0x41f6, 'current_random_mode': 0x4074,
-	             'menu_state': 0x406d, 'execute_command': 0x4070, 'execute_command2': 0x4071}
-
-	execute_commands = {'start_ramp': 0x21}
-
-	boxNetworkAddressAutoDetected = pyqtSignal(str)
-	commUpdated = pyqtSignal()
-	boxCommClosed = pyqtSignal()
-	statusUpdated = pyqtSignal(int, str)
-	modeChanged = pyqtSignal(int)
-	updatePowerRangeLevel = pyqtSignal(int)
-	advancedParamsUpdated = pyqtSignal()
-	potsOverrideUpdated = pyqtSignal(bool)
+from mk312core import BoxWorker, BoxController, DiscoveryService, RemoteControl, UDPServer, loadFunscript, FunscriptPlayer, MpvClock, UDPClock
 
-	def __init__(self):
-		QObject.__init__(self)
-		self.box = None
-		self.state = self.CLOSED
-		self.portName = None
-		self.socatRedirector = None
-
-		self.thread = QThread()
-		self.thread.setObjectName("BoxWorker thread")
-		self.moveToThread(self.thread)
-		self.thread.started.connect(self.worker)
-		self.thread.start()
-
-	def open(self, portName):
-		self.portName = portName
-
-	def close(self):
-		self.portName = None
-
-	def stop(self):
-		self.state = self.EXITING
-		self.portName = None
-
-	def getValue(self, name):
-		if name not in self.paramsValues:
-			return float('nan')
-		return self.paramsValues[name]
-
-	def setValue(self, name, value):
-		if name not in self.registers:
-			self.statusUpdated.emit(2, "Register '%s' unknown (bug?)" % (name))
-		else:
-			self.registersToWrite[name] = value
-
-	def rampStart(self):
-		self.setValue('execute_command', self.execute_commands['start_ramp'])
-
-	def discover(self, timeout=0.5):
-		UDP_DISCOVERY_PORT = 8842
-		message = b"ICQ-MK312"
-
-		hosts = set()
-		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-		server.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-		server.settimeout(timeout)
-		try:
-			server.sendto(message, ('255.255.255.255', UDP_DISCOVERY_PORT))
-			t = time.time()
-
-			while(True):
-				data, addr = server.recvfrom(1024)
-				elapsed_ms = 1000 * (time.time() - t)
-				print("%.2f (%.2fms) %s: %s (%s)" % (time.time(), elapsed_ms, addr[0], data, '.'.join(map(str, data))))
-				if addr[1] == UDP_DISCOVERY_PORT:
-					hosts.add(addr[0])
-
-		except socket.timeout:
-			pass
-
-		# "Network is unreachable" can happen when waking up from sleep
-		except OSError as e:
-			print(str(e))
-			time.sleep(1)
-			pass
-
-		except Exception as e:
-			raise(e)
-
-		return hosts
-
-	def worker(self):
-		def writeRegistersToBox():
-			for i, name in enumerate(self.registersToWrite.copy()):
-				requestedValue = self.registersToWrite[name]
-				if type(self.registers[name]) == dict:
-					addr = self.registers[name]['addr']
-					if 'bit' in self.registers[name]:
-						bit = self.registers[name]['bit']
-						value = self.box.peek(addr)
-						value&= ~(1 << bit)
-						if requestedValue:
-							value|= 1 << bit
-					else:
-						value = requestedValue
-				else:
-					addr = self.registers[name]
-					value = requestedValue
-
-				print(name, addr, value)
-				if name == 'current_mode' and self.modes[value] == "None":
-					value = 0x90
-					# so let's get it into a blank empty mode. easiest way is calltable 18
-					self.box.poke(0x4078, [0x90]) # mode 90 doesn't exist
-					self.box.poke(0x4070, [18]) # execute mode 90
-					i = 0
-					while (self.box.peek(0x4070) != 0xff and i < 50):
-						i+=1
-					for base in [0x4000,0x4100]:
-						# init
-						self.box.poke(base+0xa8, [0,0]) # don't increment channel intensity
-						self.box.poke(base+0xa5, [128]) # A intensity mod value = min
-						self.box.poke(base+0xac, [0]) # no select
-						self.box.poke(base+0xb1, [0]) # rate
-						self.box.poke(base+0xae, [0x64]) # freq mod
-						self.box.poke(base+0xb5, [4]) # select normal parms
-						self.box.poke(base+0xb7, [0xc8]) # width mod value
-						self.box.poke(base+0xba, [0]) # width mod value
-						self.box.poke(base+0xbe, [4]) # select normal parms
-						self.box.poke(base+0x9c, [255]) # ramp off
-
-						# actuated
-						# ~ self.box.poke(base+0xac, [0]) # no select
-					self.overWriteDisplay("None")
-					del self.registersToWrite[name]
-					continue
-
-				self.box.poke(addr, [value])
-
-				if name == 'current_mode':
-					self.box.poke(0x4070, [0x4, 0x12])
-					time.sleep(0.018)
-				elif name.startswith("advparam_"):
-					self.box.poke(0x4070, [0x20])
-					time.sleep(0.018)
-
-				if requestedValue == self.registersToWrite[name]:
-					del self.registersToWrite[name]
-
-				if i > 3:
-					break
-
-		def storeParamValue(name):
-			if type(self.registers[name]) == dict:
-				register = self.registers[name]['addr']
-				if 'bit' in self.registers[name]:
-					value = self.box.peek(register) & (1 << self.registers[name]['bit'])
-
-				elif 'offset' in self.registers[name]:
-					offset = self.registers[name]['offset']
-					value = self.box.peek(register) - offset
-			else:
-				register = self.registers[name]
-				value = self.box.peek(register)
-
-			self.paramsValues[name] = value
-			return value
-
-		def overWriteDisplay(text, posOffset=None):
-			if posOffset is None:
-				self.box.poke(0x4180, [0x64])
-				self.box.poke(0x4070, [0x15])
-				while (self.box.peek(0x4070) != 0xff):
-					pass
-
-				posOffset = 9 if len(text) < 8 else 8
-
-			if posOffset == 0:
-				self.box.poke(self.registers["menu_state"], [1])
-
-			for pos, char in enumerate(text):
-				self.box.poke(0x4180, [ord(char), pos+posOffset])
-				self.box.poke(0x4070, [0x13])
-				i = 0
-				while (self.box.peek(0x4070) != 0xff and i < 50):
-					i+=1
-
-		print("Starting BoxWorker.worker()")
-		self.paramsValues = {}
-		self.registersToWrite = {}
-		self.displayMessagesToWrite = []
-		self.errorCounter = 0
-
-		while(self.state != self.EXITING):
-			if self.state == self.CLOSED:
-				if self.portName != None:
-					self.state = self.OPENING
-					continue
-				else:
-					for addr in self.discover():
-						self.boxNetworkAddressAutoDetected.emit(addr)
-				time.sleep(0.5)
-
-			elif self.state == self.CLOSING:
-				try:
-					writeRegistersToBox()
-					self.box.close()
-					self.state = self.CLOSED
-					self.statusUpdated.emit(1, "Port closed.")
-					self.boxCommClosed.emit()
-				except Exception as e:
-					self.statusUpdated.emit(3, str(e))
-
-			elif self.state == self.OPENING:
-				if self.portName == None:
-					self.statusUpdated.emit(1, "Aborting etablishing connection...")
-					self.state = self.CLOSED
-					continue
-
-				self.registersToWrite = {}
-				self.displayMessagesToWrite = []
-				try:
-					if re.search('^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}:[0-9]+$', self.portName):
-						host, port = self.portName.split(':')
-						self.box = MK312(NetworkLink(host, port=int(port)), encrypted=True)
-					elif re.search('^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}$', self.portName):
-						self.box = MK312(NetworkLink(self.portName, port=8843), encrypted=False)
-					else:
-						self.box = MK312(SerialLink(self.portName))
-					self.state = self.CONNECTED
-					self.errorCounter = 0
-
-					storeParamValue("battery_voltage_boot")
-
-					v = storeParamValue("power_level_range")
-					self.updatePowerRangeLevel.emit(v)
-
-					usermodes = storeParamValue("user_modes_loaded")
-					for i in range (0,usermodes):
-						startmodule = self.box.peek(0x8018+i)
-						if (startmodule < 0xa0):
-							programlookup = self.box.peek(0x8000+startmodule-0x60)
-							programblockstart = 0x8040+programlookup
-						else:
-							programlookup = self.box.peek(0x8000+startmodule-0xa0)
-							programblockstart = 0x8100+programlookup
-						print("\tUser %d is module 0x%02x\t: 0x%04x (eeprom)"%(i+1,startmodule,programblockstart))
-
-					storeParamValue("box_version")
-					storeParamValue("v1")
-					storeParamValue("v2")
-					storeParamValue("v3")
-					self.potsOverrideUpdated.emit(storeParamValue('adc_disable'))
-
-
-					storeParamValue('advparam_ramp_level')
-					storeParamValue('advparam_ramp_time')
-					storeParamValue('advparam_depth')
-					storeParamValue('advparam_tempo')
-					storeParamValue('advparam_frequency')
-					storeParamValue('advparam_effect')
-					storeParamValue('advparam_width')
-					storeParamValue('advparam_pace')
-					self.advancedParamsUpdated.emit()
-
-					self.statusUpdated.emit(1, "Connected and synchronised!")
-					lastMode = None
-
-				except Exception as e:
-					self.errorCounter+=1
-					msg = str(e)
-					if self.errorCounter < 4:
-						self.statusUpdated.emit(2, msg)
-					else:
-						msg+="\nCannot synchronise with mk312... "
-						if "received no reply" in msg:
-							msg+="Is the box connected and powered on?"
-						else:
-							msg+="Try to turn off the box and on again?"
-						self.statusUpdated.emit(3, msg)
-					time.sleep(.2)
-
-			elif self.state == self.CONNECTED:
-				if self.portName == None:
-					self.state = self.CLOSING
-					continue
-
-				try:
-					writeRegistersToBox()
-					if len(self.displayMessagesToWrite):
-						overWriteDisplay(*self.displayMessagesToWrite.pop(0))
-
-					# ~ storeParamValue("current_sense") # ADC0
-					storeParamValue("multiadjust_scaled")
-
-					currentmode = storeParamValue("current_mode")
-					if currentmode != lastMode:
-						storeParamValue("multiadjust_min")
-						storeParamValue("multiadjust_max")
-
-						self.modeChanged.emit(currentmode)
-						lastMode = currentmode
-
-						v = storeParamValue("power_level_range")
-						self.updatePowerRangeLevel.emit(v)
-
-
-						if (currentmode == 0x7f):
-							storeParamValue("channel_a_split_mode")
-							storeParamValue("channel_b_split_mode")
-						if (currentmode == 0x80):
-							storeParamValue("current_random_mode")
-							# ~ timeleft = self.box.peek(0x4075) - self.box.peek(0x406a)
-							# ~ if (timeleft<0):
-								# ~ timeleft+=256
-							# ~ print("\tTime until change mode\t: {0:#d} seconds ".format(int(timeleft/1.91)))
-						# ~ print("\tMode has been running\t: {0:#d} seconds".format(int((self.box.peek(0x4089)+self.box.peek(0x408a)*256)*1.048)))
-
-
-					storeParamValue("psu_voltage") # ADC2
-					storeParamValue("battery_voltage") # ADC3
-
-					storeParamValue("channel_a_level") # ADC4
-					storeParamValue("channel_b_level") # ADC5
-
-
-					self.commUpdated.emit()
-
-					# ~ storeParamValue('advparam_ramp_level')
-					# ~ storeParamValue('advparam_ramp_time')
-					# ~ storeParamValue('advparam_depth')
-					# ~ storeParamValue('advparam_tempo')
-					# ~ storeParamValue('advparam_frequency')
-					# ~ storeParamValue('advparam_effect')
-					# ~ storeParamValue('advparam_width')
-					# ~ storeParamValue('advparam_pace')
-					# ~ advancedParamsUpdated.emit()
-
-					self.errorCounter = 0
-				except Exception as e:
-					self.errorCounter+=1
-					self.statusUpdated.emit(3, str(e))
-					if self.errorCounter % 5 == 0:
-						try:
-							 # important or the MK312 object is not deleted
-							self.box.close()
-							self.box = None
-						except Exception as e:
-							print(str(e))
-						self.state = self.OPENING
-
-		try:
-			# if possible, reset the key and close the interface
-			self.box.close()
-		except:
-			pass
-		print("BoxWorker ended")
-
-	def overWriteDisplay(self, text, posOffset=None, line=None):
-		if posOffset is None and line is not None:
-			posOffset = 0
-		if line==2: posOffset+=64
-		self.displayMessagesToWrite.append((text, posOffset))
-
-
-class MK312():
-	def __init__(self, link, encrypted=True):
-		self.link = link                   # the Communication layer to the device
-		self.encryptionEnabled = encrypted # do we use the Encryptionless method or not
-		self.needHandshake = True
-
-		self._flushInputBuffer()
-		self._handshake()
-		self._negotiateKeys()
-
-	def _flushInputBuffer(self):
-		attempts = 0
-		while (True):
-			s = self.link.recv(1024)
-			if not s:
-				break
-			attempts+=1
-			print("Flushed:", s)
-			if attempts > 5:
-				s = str(s)
-				if len(s) > 20:
-					s = s[:20] + '...'
-				raise Exception("Device doesn't stop sending bytes (%s)" % (s))
-
-	def _handshake(self):
-		""" Attempts the handshake with the MK312 device """
-		attempts = 0
-		ok = 0
-		while (True):
-			self.link.send(bytes([0x00])) # Send a 0 as a hello
-			time.sleep(0.1)
-			reply = self.link.recv(1)
-			if (len(reply) == 1 and reply[0] == 0x07):
-				ok+=1
-				if ok > 2:
-					self.needHandshake = False
-					break
-				continue
-			ok=0
-			attempts+=1
-			if (attempts > 12): raise Exception("Handshake with device failed")
-
-	def _negotiateKeys(self):
-		""" Do the key handshake with the device """
-
-		# this encryptionless mode is only supported by RexLabs Wifi adapter
-		# (https://github.com/Rangarig/MK312WIFI/)
-		if (not self.encryptionEnabled):
-			self.link.send(bytes((0x2f, 0x42, 0x42)))
-			rx = self.link.recv(100)
-			if len(rx) != 1 or rx[0] != 0x69: raise Exception("Failed to establish non encrypted mode")
-			return
-
-		# Send key negotiation
-		# code is working only if it is set to zero, but does not seems to break the connection
-		hostKey = 0x00          # The key sent by us, 0 for simplicity
-		extraEncryptKey = 0x55  # The key always added to the encryption
-		while True:
-			self.link.send(bytes((0x2f, hostKey, 0x2f)))
-			data = self._read(3) # this does the checksum validation
-			if len(data) == 2:
-				break
-
-		boxkey = data[1]
-		self.encryptionKey = (boxkey ^ hostKey ^ extraEncryptKey)
-
-	def _write(self, data):
-		checksum = sum(data) % 256
-		data.append(checksum)
-
-		if self.encryptionEnabled:
-			data = [x ^ self.encryptionKey for x in data]
-		self.link.send(bytes(data))
-
-	def _read(self, length):
-		start = time.time()
-		data = self.link.recv(length)
-
-		# this is a workaround for MK312-WIFI firmware prior to v1.2.02 (sending a packet per byte)
-		while len(data) < length and time.time() < start + 0.5:
-			data+= self.link.recv(length-len(data))
-
-		if len(data) < length:
-			self.needHandshake = True
-			raise Exception("Unable to receive all the requested bytes (%d < %d)" % (len(data), length))
-
-		data, checksum = data[:-1], data[-1]
-		computedChecksum = sum(data) % 256
-		if computedChecksum != checksum:
-			self.needHandshake = True
-			raise Exception("Checksum mismatch! (%s %02x, computed %02x)" % (data.hex(), checksum, computedChecksum))
-		return data
-
-	def peek(self, address):
-		if self.needHandshake:
-			self._handshake()
-
-		self._write([0x3c, address >> 8, address & 0xff])
-		data = self._read(3)
-		return data[1]
-
-	def poke(self, startAddress, data):
-		if not self.link: return
-
-		if self.needHandshake:
-			self._handshake()
-
-		if type(data) is not list:
-			raise TypeError("data must be a list")
-		length = len(data)
-		if length == 0 or length > 8:
-			raise Exception("Can only write between 1-8 bytes")
-
-		txData = [0x0d | ((length+3) << 4), startAddress >> 8, startAddress & 0xff] + data
-		txData.append(sum(txData) % 256)
-
-		if not self.encryptionEnabled:
-			self.link.send(bytes(txData))
-		else:
-			self.link.send(bytes([b ^ self.encryptionKey for b in txData]))
-
-		ackCode = self.link.recv(1)
-		return ackCode
-
-	def close(self):
-		if self.encryptionEnabled:
-			self.poke(0x4213, [0x0]) # reset key
-		self.link = None
 
+class GuiSlot(QObject):
+	""" Calls a function in the GUI thread when a signal of the core (emitted from its threads) is received """
+	called = pyqtSignal(tuple)
 
-class NetworkLink():
-	def __init__(self, ip, port, debug=False):
-		self.debug = debug
-		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket.settimeout(0.5)
-		self.socket.connect((ip, port))
-
-	def send(self, data):
-		if self.debug: print("send", data.hex())
-		self.socket.send(data)
-
-	def recv(self, length=1):
-		try:
-			data = self.socket.recv(length)
-			if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
-		except (TimeoutError, socket.timeout):
-			data = b""
-			if self.debug: print("recv (timeout) (0/%d)" % (length))
-		return data
-
-
-class SerialLink():
-	def __init__(self, port, baudrate=19200, debug=False):
-		self.debug = debug
-		if self.debug: print("opening serial port", port)
-		self.serial = serial.Serial(port, baudrate, timeout=0.2, parity=serial.PARITY_NONE, bytesize=8, stopbits=1, xonxoff=0, rtscts=0)
-		if fcntl is not None:
-			fcntl.flock(self.serial.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-
-	def send(self, data):
-		if self.debug: print("send", data.hex())
-		self.serial.write(data)
-
-	def recv(self, length=1):
-		data = self.serial.read(length)
-		if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
-		return data
-
-	def __del__(self):
-		if self.debug: print("serial port closed.")
-		self.serial.close()
-		del self.serial
+	def __init__(self, signal, function, parent):
+		QObject.__init__(self, parent)
+		self.called.connect(lambda args: function(*args))
+		signal.connect(lambda *args: self.called.emit(args))
 
 
 boxWorker = BoxWorker()
+discoveryService = DiscoveryService()
+boxController = BoxController()
+boxController.addBox('main', boxWorker, groups=(boxController.remoteGroup,))
+remoteControl = RemoteControl(boxController, boxController.remoteGroup)
 
 class RegistersView(QTableWidget):
 	closed = pyqtSignal()
@@ -644,6 +103,35 @@ class RegistersView(QTableWidget):
 				self.cellWidget(i, 1).setText(str(parameters[parameterName]))
 
 
+class LinkStatsView(QPlainTextEdit):
+	closed = pyqtSignal()
+
+	def __init__(self, remoteStats=()):
+		QPlainTextEdit.__init__(self)
+		self.remoteStats = list(remoteStats) + [("Remote control jitter buffer", remoteControl.stats)] # [(title, LinkStats)]
+		self.setReadOnly(True)
+		self.setLineWrapMode(self.NoWrap)
+		self.setFont(QFont("Monospace", 9))
+		self.resize(560, 300)
+		self.setWindowTitle(u"Link Statistics")
+		self.refresh()
+
+		self.show()
+		self.timer = QTimer()
+		self.timer.timeout.connect(self.refresh)
+		self.timer.start(1000)
+
+	def closeEvent(self, event):
+		self.closed.emit()
+		event.accept()
+
+	def refresh(self):
+		text = boxController.formatStats()
+		for title, stats in self.remoteStats:
+			text+= '\n\n' + stats.format(title)
+		self.setPlainText(text)
+
+
 class ScreenEdit(QDialog):
 	closed = pyqtSignal()
 
@@ -733,38 +221,59 @@ class GUI(QWidget):
 
 		self.screenEditWindow = None
 		self.registersWindow = None
+		self.linkStatsWindow = None
 
-		boxWorker.statusUpdated.connect(self.boxStatusUpdated)
-		boxWorker.commUpdated.connect(self.boxCommUpdated)
-		boxWorker.boxCommClosed.connect(self.boxCommClosed)
-		boxWorker.modeChanged.connect(self.updateMode)
-		boxWorker.updatePowerRangeLevel.connect(self.updatePowerRangeLevel)
+		GuiSlot(boxWorker.statusUpdated, self.boxStatusUpdated, self)
+		GuiSlot(boxWorker.commUpdated, self.boxCommUpdated, self)
+		GuiSlot(boxWorker.boxCommClosed, self.boxCommClosed, self)
+		GuiSlot(boxWorker.modeChanged, self.updateMode, self)
+		GuiSlot(boxWorker.updatePowerRangeLevel, self.updatePowerRangeLevel, self)
 		self.initUI()
-		boxWorker.boxNetworkAddressAutoDetected.connect(self.serialPortPicker.addPort)
-		boxWorker.advancedParamsUpdated.connect(self.advParameters.paramsUpdate)
-		boxWorker.potsOverrideUpdated.connect(lambda state: self.potsOverrideClicked(state))
+		GuiSlot(discoveryService.hostDiscovered, self.serialPortPicker.addPort, self)
+		discoveryService.start()
+		GuiSlot(boxWorker.advancedParamsUpdated, self.advParameters.paramsUpdate, self)
+		GuiSlot(boxWorker.potsOverrideUpdated, lambda state: self.potsOverrideClicked(state), self)
+		GuiSlot(boxWorker.userModesUpdated, self.userModesUpdated, self)
 
+		self.udpServer = None
 		try:
-			self.udpServer = UDP_ServerWorker(port=50000)
-			self.udpServer.receivedPacket.connect(self.handleUDPMessage)
+			self.udpServer = UDPServer(port=50000)
+			remoteControl.connect(self.udpServer)
 		except Exception as e:
 			QMessageBox.warning(self, "UDP REMote control port error", str(e))
 			for ch in self.channels:
 				ch.setUdpServerIsHavingProblem(True)
 
-	def handleUDPMessage(self, msg):
-		factor = 0
-		try:
-			if msg != '':
-				factor = float(msg)
-		except Exception as e:
-			print(str(e))
-
-		self.channels[0].setRemoteValueFactor(factor)
-		self.channels[1].setRemoteValueFactor(factor)
+		# the remote controlled levels are written without the GUI, their display is only refreshed periodically
+		self.remoteDisplayGeneration = None
+		self.remoteDisplayTimer = QTimer()
+		self.remoteDisplayTimer.timeout.connect(self.refreshRemoteDisplay)
+		self.remoteDisplayTimer.start(50)
+		self.remoteInfosTimer = QTimer()
+		self.remoteInfosTimer.timeout.connect(self.refreshRemoteInfos)
+		self.remoteInfosTimer.start(500)
+
+	def refreshRemoteDisplay(self):
+		generation, levels, multiAdjust = remoteControl.snapshot()
+		if generation == self.remoteDisplayGeneration:
+			return
+		self.remoteDisplayGeneration = generation
+		remoteChannels = [ch for ch in self.channels if ch.btnRemote.isChecked()]
+		for ch in remoteChannels:
+			if ch.writeRegisterName in levels and ch.levelBar.value() != levels[ch.writeRegisterName]:
+				ch.levelBar.setValue(levels[ch.writeRegisterName])
+		if remoteChannels and multiAdjust is not None:
+			self.multiAdjust.showPosition(multiAdjust)
+
+	def refreshRemoteInfos(self):
+		status = remoteControl.status()
+		if not status['applied']:
+			return
+		self.infos.setText("Remote sync: buffer %d ms (%d queued), box latency %.1f ms, skew %+.1f ms, %d late" %
+		                   (1000 * status['buffer_delay'], status['queued'], 1000 * status['lead'], 1000 * status['skew'], status['late']))
 
 	def closeEvent(self, event):
-		boxWorker.close()
+		boxController.close()
 		if self.registersWindow:
 			self.registersWindow.close()
 		if self.screenEditWindow:
@@ -790,7 +299,17 @@ class GUI(QWidget):
 		");
 		self.setObjectName("backgroundWidget")
 		layout = QVBoxLayout(self)
-		self.serialPortPicker = SerialPortPicker(self, boxWorker.open, boxWorker.close)
+
+		# the discovery broadcasts are not needed while talking with a box
+		def openPort(portName):
+			boxWorker.open(portName)
+			discoveryService.setPaused(True)
+
+		def closePort():
+			boxWorker.close()
+			discoveryService.setPaused(False)
+
+		self.serialPortPicker = SerialPortPicker(self, openPort, closePort)
 		layout.addLayout(self.serialPortPicker)
 
 		def mkQLabel(text=None, layout=None, alignment=Qt.AlignLeft, objectName=None):
@@ -845,7 +364,6 @@ class GUI(QWidget):
 				self.isDefaultPosition = True
 				self.writeRegisterName = writeRegisterName
 				self.remServerNotWorking = False
-				self.remoteControlFactor = 0.0
 
 				channelsLayout.addWidget(self)
 				layout = QVBoxLayout(self)
@@ -943,16 +461,6 @@ class GUI(QWidget):
 
 				self.dialValueChanged()
 
-			def setRemoteValueFactor(self, factor):
-				self.remoteControlFactor = float(factor)
-				if self.remoteControlFactor < 0:
-					self.remoteControlFactor = 0
-				elif self.remoteControlFactor > 2:
-					self.remoteControlFactor = 2
-
-				if self.btnRemote.isChecked():
-					self.dialValueChanged()
-
 			def update(self, value): #todo: change that name
 				self.value = value
 				if not self.enabled or self.isDefaultPosition:
@@ -971,8 +479,11 @@ class GUI(QWidget):
 				self.computeValue(value)
 
 			def computeValue(self, value):
-				if self.btnRemote.isChecked():
-					value*=self.remoteControlFactor
+				if self.btnRemote.isChecked() and self.enabled:
+					# written by remoteControl on each factor received
+					remoteControl.setChannel(self.writeRegisterName, value, 25.5 if self.btnSurge.isPressed else 0)
+					return
+				remoteControl.setChannel(self.writeRegisterName, None)
 				if self.btnSurge.isPressed:
 					value+=25.5
 				if self.btnCut.isChecked():
@@ -985,6 +496,8 @@ class GUI(QWidget):
 					boxWorker.setValue(self.writeRegisterName, value)
 
 			def setEnabled(self, state):
+				if not state:
+					remoteControl.setChannel(self.writeRegisterName, None)
 				self.dial.setEnabled(state)
 				for b in self.btnSurge, self.btnNorm, self.btnRemote, self.btnCut:
 					b.blockSignals(True)
@@ -1039,6 +552,11 @@ class GUI(QWidget):
 				if self.enabled:
 					boxWorker.setValue(self.writeRegisterName, (self.valMax - value))
 
+			def showPosition(self, position):
+				self.dial.blockSignals(True)
+				self.dial.setValue(int(round(position * self.dial.maximum())))
+				self.dial.blockSignals(False)
+
 			def setEnabled(self, state):
 				self.enabled = state
 				self.dial.setEnabled(state)
@@ -1148,6 +666,16 @@ class GUI(QWidget):
 
 		self.showRegistersBtn = mkButton("Show Registers", layout2, function=showRegistersBtnClicked, setCheckable=True)
 
+		def showLinkStatsBtnClicked(state):
+			if state:
+				self.linkStatsWindow = LinkStatsView([("Remote control statistics", self.udpServer.stats)] if self.udpServer else [])
+				self.linkStatsWindow.closed.connect(lambda: self.showLinkStatsBtn.setChecked(False))
+			elif self.linkStatsWindow != None:
+				self.linkStatsWindow.close()
+				self.linkStatsWindow = None
+
+		self.showLinkStatsBtn = mkButton("Stats", layout2, function=showLinkStatsBtnClicked, setCheckable=True, toolButton=True)
+
 		def showScreenEditBtnClicked(state):
 			if state:
 				self.screenEditWindow = ScreenEdit(self)
@@ -1266,17 +794,24 @@ class GUI(QWidget):
 			w.setEnabled(state)
 		self.potsOverrideBtn.setChecked(state)
 
-	def fillModes(self):
+	def fillModes(self, userModes=7):
 		self.mode.blockSignals(True)
 		self.mode.clear()
 		modesText = []
 		self.modeNames2Id = {}
 		for k in boxWorker.modes:
+			if k >= 0x88 + userModes:
+				continue
 			modesText.append(boxWorker.modes[k])
 			self.modeNames2Id[boxWorker.modes[k]] = k
 		self.mode.insertItems(0, modesText)
 		self.mode.blockSignals(False)
 
+	def userModesUpdated(self, count):
+		self.fillModes(count)
+		if 'current_mode' in boxWorker.paramsValues:
+			self.updateMode(boxWorker.paramsValues['current_mode'])
+
 	def updateMode(self, modeId):
 		self.mode.blockSignals(True)
 		try:
@@ -1352,6 +887,9 @@ class SerialPortPicker(QHBoxLayout):
 			self.serialDeviceCombo.clear()
 			self.serialDeviceCombo.insertItems(0, self.listSerialPorts())
 			self.serialDeviceCombo.insertSeparator(self.serialDeviceCombo.count())
+			for host, lastSeen, latency in discoveryService.cachedHosts():
+				self.serialDeviceCombo.addItem(host)
+				self.serialDeviceCombo.setItemData(self.serialDeviceCombo.count()-1, "Seen %s, replied in %.1fms" % (time.strftime("%H:%M:%S", time.localtime(lastSeen)), 1000 * latency), Qt.ToolTipRole)
 			self.serialDeviceCombo.setCurrentIndex(-1)
 		except Exception as e:
 			QMessageBox.warning(self.parentWidget, "Serial port error", str(e))
@@ -1383,43 +921,59 @@ class SerialPortPicker(QHBoxLayout):
 		self.closeBtn.setDisabled(True)
 
 
-class UDP_ServerWorker(QObject):
-	receivedPacket = pyqtSignal(str)
-
-	def __init__(self, port=50000):
-		QObject.__init__(self)
-		self.port = port
-		self.receive_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-		self.receive_socket.bind(('', self.port))
-		self.serverThread = QThread()
-		self.serverThread.setObjectName("UDP Server Thread")
-		self.moveToThread(self.serverThread)
-		self.serverThread.started.connect(self.run)
-		self.serverThread.start()
-
-	def run(self):
-		self.exitLoop = False
-
-		while not self.exitLoop:
-			msg, addr = self.receive_socket.recvfrom(4096)
-			try:
-				for content in msg.decode('ascii').strip().split("\n"):
-					self.receivedPacket.emit(content)
-
-			except Exception as e:
-				print('UDP ERROR: '+str(e))
-
-
-	def stop(self):
-		self.exitLoop = True
-
 def main():
-	app = QApplication(sys.argv)
+	parser = argparse.ArgumentParser(description="MK-312 Remote Control")
+	parser.add_argument('--trace', metavar='FILE', help="record the traffic with the box in this file (see utils/mk312replay.py)")
+	parser.add_argument('--box', metavar='PORT[@GAIN]', action='append', default=[], help="additional box following the remote controlled levels, with a gain (1.0 by default)")
+	parser.add_argument('--remote-buffer', metavar='SECONDS', type=float, default=remoteControl.bufferDelay, help="delay of the timestamped remote control messages, for absorbing the jitter (0 to disable)")
+	parser.add_argument('--max-age', metavar='SECONDS', type=float, default=0, help="drop the remote control messages (v2) older than this, only if the clock of the sender is synchronised with this one (0 to keep them)")
+	parser.add_argument('--funscript', metavar='FILE', help="play this funscript (or timeline, see utils/funscript2srt.py) on the remote controlled channels (on channel A only with --funscript-b)")
+	parser.add_argument('--funscript-b', metavar='FILE', help="funscript for channel B")
+	parser.add_argument('--mpv-socket', metavar='PATH', help="follow the position of mpv (mpv --input-ipc-server=PATH) instead of the one sent by subsync.lua")
+	args, qtArguments = parser.parse_known_args()
+	boxWorker.tracePath = args.trace
+	remoteControl.bufferDelay = args.remote_buffer
+
+	scripts = {}
+	try:
+		if args.funscript:
+			scripts['channel_a_level'] = scripts['channel_b_level'] = loadFunscript(args.funscript)
+		if args.funscript_b:
+			scripts['channel_b_level'] = loadFunscript(args.funscript_b)
+	except Exception as e:
+		parser.error("can't load the funscript: %s" % (e))
+	if args.mpv_socket and not MpvClock.supported:
+		parser.error("--mpv-socket is not supported on this system, the position can be sent by subsync.lua instead")
+
+	for i, box in enumerate(args.box):
+		portName, gain = box.split('@') if '@' in box else (box, 1.0)
+		name = 'box%d' % (i+2)
+		worker = boxController.addBox(name, gain=float(gain), groups=(boxController.remoteGroup,), overridePots=True)
+		if args.trace:
+			worker.tracePath = "%s.%s" % (args.trace, name)
+		worker.open(portName)
+
+	app = QApplication(sys.argv[:1] + qtArguments)
 	m1 = GUI()
 	app.installEventFilter(m1)
+	if m1.udpServer:
+		m1.udpServer.maxAge = args.max_age
+	if scripts:
+		if args.mpv_socket:
+			clock = MpvClock(args.mpv_socket)
+		else:
+			clock = UDPClock()
+			if m1.udpServer:
+				clock.connect(m1.udpServer)
+		player = FunscriptPlayer(remoteControl, clock, scripts)
 	ret = app.exec_()
-	boxWorker.stop()
+	if scripts:
+		player.stop()
+	remoteControl.stop()
+	boxController.stop()
+	discoveryService.stop()
 	time.sleep(1)
+	print(boxController.formatStats())
 	sys.exit(ret)
 
 def getEmbeddedIcon():
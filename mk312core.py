@@ -0,0 +1,2320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# https://github.com/clxjaguar/mk312-gui
+# MK312 protocol, links and box workers, without any GUI (used by mk312-gui.py and mk312-daemon.py)
+
+import re, sys, time, socket, serial, collections, threading, asyncio, bisect, heapq, struct, json, mmap, os, zlib
+
+# the fcntl module seems to not to exists on windows
+try: import fcntl
+except: fcntl = None
+
+class Signal():
+	""" Stand-in for the Qt signals, declared in the class the same way.
+	The connected functions are called directly, from the thread emitting the signal. """
+	def __init__(self, *types):
+		self.types = types
+
+	def __set_name__(self, owner, name):
+		self.name = name
+
+	def __get__(self, instance, owner):
+		if instance is None:
+			return self
+		# stored in the instance, so this is only called the first time
+		bound = instance.__dict__[self.name] = BoundSignal()
+		return bound
+
+
+class BoundSignal():
+	def __init__(self):
+		self.slots = []
+
+	def connect(self, slot):
+		self.slots.append(slot)
+
+	def disconnect(self, slot):
+		self.slots.remove(slot)
+
+	def emit(self, *args):
+		for slot in list(self.slots):
+			slot(*args)
+
+
+class ShadowRegisters():
+	""" Last known values of the box registers, with the time they were read """
+	STATIC = 0     # never changes during a session, read once
+	SLOW = 1       # read again after its TTL expired
+	HOT = 2        # read on every poll cycle
+	MODE = 3       # read again when the current mode changes
+	ON_DEMAND = 4  # never polled, only read when explicitly requested
+
+	def __init__(self, policies):
+		self.policies = policies # {name: (refreshClass, ttl)}
+		self.values = {}
+		self.timestamps = {}
+
+	def store(self, name, value, now=None):
+		self.values[name] = value
+		self.timestamps[name] = time.time() if now is None else now
+
+	def isStale(self, name, now=None):
+		if name not in self.timestamps:
+			return True
+		refreshClass, ttl = self.policies.get(name, (self.ON_DEMAND, None))
+		if refreshClass == self.HOT:
+			return True
+		if refreshClass == self.SLOW:
+			return (time.time() if now is None else now) - self.timestamps[name] >= ttl
+		return False
+
+	def stale(self, names, now=None):
+		now = time.time() if now is None else now
+		return [name for name in names if self.isStale(name, now)]
+
+	def expire(self, name):
+		self.timestamps.pop(name, None)
+
+	def invalidate(self, refreshClass):
+		for name, policy in self.policies.items():
+			if policy[0] == refreshClass:
+				self.expire(name)
+
+	def clear(self):
+		self.values.clear()
+		self.timestamps.clear()
+
+
+class LinkStats():
+	""" Always-on round-trip time histograms (per kind of transaction) and error counters of the link to the box """
+	bucketLimits = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0) # seconds, plus one bucket for longer times
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		with self.lock:
+			self.since = time.time()
+			self.histograms = {} # {operation: [count per bucket]}
+			self.totals = {}     # {operation: [count, total time, max time]}
+			self.recent = {}     # {operation: moving average of the time}
+			self.counters = collections.Counter()
+
+	def record(self, operation, duration):
+		bucket = bisect.bisect_left(self.bucketLimits, duration)
+		with self.lock:
+			histogram = self.histograms.get(operation)
+			if histogram is None:
+				histogram = self.histograms[operation] = [0] * (len(self.bucketLimits) + 1)
+				self.totals[operation] = [0, 0.0, 0.0]
+			histogram[bucket]+= 1
+			total = self.totals[operation]
+			total[0]+= 1
+			total[1]+= duration
+			total[2] = max(total[2], duration)
+			self.recent[operation] = 0.9 * self.recent.get(operation, duration) + 0.1 * duration
+
+	def recentMean(self, operation):
+		""" Moving average of the last times of an operation (seconds), 0 if unknown """
+		with self.lock:
+			return self.recent.get(operation, 0)
+
+	def count(self, name, increment=1):
+		with self.lock:
+			self.counters[name]+= increment
+
+	def snapshot(self):
+		""" Returns a copy of the statistics, the percentiles are the upper limits of the buckets they are in (in ms) """
+		with self.lock:
+			operations = {}
+			for operation, histogram in self.histograms.items():
+				count, total, maxTime = self.totals[operation]
+				limits = [1000 * l for l in self.bucketLimits] + [1000 * maxTime]
+				def percentile(p):
+					seen = 0
+					for limit, n in zip(limits, histogram):
+						seen+= n
+						if seen >= p * count:
+							return min(limit, 1000 * maxTime)
+				operations[operation] = {'count': count, 'mean_ms': 1000 * total / count, 'max_ms': 1000 * maxTime,
+				                         'p50_ms': percentile(0.5), 'p90_ms': percentile(0.9), 'p99_ms': percentile(0.99),
+				                         'histogram': list(histogram)}
+			return {'duration': time.time() - self.since, 'operations': operations, 'counters': dict(self.counters)}
+
+	def format(self, title="Link statistics"):
+		snapshot = self.snapshot()
+		lines = ["%s over %.1fs" % (title, snapshot['duration'])]
+		lines.append("%-12s %8s %8s %8s %8s %8s %8s" % ("", "count", "mean", "p50", "p90", "p99", "max"))
+		for operation, s in sorted(snapshot['operations'].items()):
+			lines.append("%-12s %8d %6.1fms %6.1fms %6.1fms %6.1fms %6.1fms" % (operation, s['count'], s['mean_ms'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms']))
+		for name, value in sorted(snapshot['counters'].items()):
+			lines.append("%-24s %d" % (name, value))
+		return '\n'.join(lines)
+
+
+class MemoryImageCache():
+	""" Memory images of the boxes (their EEPROM) saved on disk, so they don't have to be read again on each connection """
+	def __init__(self, directory=None):
+		if directory is None:
+			directory = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'mk312-gui')
+		self.directory = directory
+
+	def path(self, key):
+		return os.path.join(self.directory, key + '.bin')
+
+	def load(self, key, length):
+		try:
+			with open(self.path(key), 'rb') as f:
+				data = f.read()
+		except OSError:
+			return None
+		return data if len(data) == length else None
+
+	def save(self, key, data):
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			# written aside then renamed, so a partial file is never used
+			with open(self.path(key) + '.tmp', 'wb') as f:
+				f.write(data)
+			os.replace(self.path(key) + '.tmp', self.path(key))
+		except OSError as e:
+			print("Unable to save %s: %s" % (self.path(key), str(e)))
+
+
+def parsePortName(portName):
+	""" Returns (host, TCP port, encrypted) for a Wi-Fi bridge (IP for the unencrypted mode, IP:port otherwise),
+	(None, None, True) for a serial port """
+	if re.search('^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}:[0-9]+$', portName):
+		host, port = portName.split(':')
+		return host, int(port), True
+	if re.search('^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}$', portName):
+		return portName, 8843, False
+	return None, None, True
+
+
+class BoxWorker():
+	CLOSED = 0
+	OPENING = 1
+	CONNECTED = 2
+	CLOSING = 3
+	EXITING = -1
+
+	modes = {0:   "None",   0x76:"Waves",  0x77:"Stroke",  0x78:"Climb",  0x79:"Combo",  0x7a:"Intense", 0x7b:"Rhythm",
+	         0x7c:"Audio1", 0x7d:"Audio2",  0x7e:"Audio3", 0x7f:"Split",  0x80:"Random1", 0x81:"Random2", 0x82:"Toggle",
+	         0x83:"Orgasm", 0x84:"Torment", 0x85:"Phase1", 0x86:"Phase2", 0x87:"Phase3",
+	         0x88:"User1",  0x89:"User2",   0x8a:"User3",  0x8b:"User4",  0x8c:"User5",   0x8d:"User6",   0x8e:"User7"}
+
+	powerlevels = {1:"Low (1)",2:"Normal (2)",3:"High (3)"}
+
+	registers = {'advparam_ramp_level': 0x41f8, 'advparam_ramp_time': 0x41f9, 'advparam_depth': 0x41fa, 'advparam_tempo': 0x41fb,
+	             'advparam_frequency': 0x41fc, 'advparam_effect': 0x41fd, 'advparam_width': 0x41fe, 'advparam_pace': 0x41ff,
+	             'current_sense': 0x4060, 'multiadjust_value': 0x4061, 'multiadjust_scaled': 0x420d,
+	             'multiadjust_min': 0x4086, 'multiadjust_max': 0x4087, 'psu_voltage': 0x4062,
+	             'battery_voltage': 0x4063, 'battery_voltage_boot': 0x4203, 'channel_a_level': 0x4064,
+	             'channel_b_level': 0x4065, 'power_level_range': 0x41f4,
+	             'user_modes_loaded': {'addr': 0x41f3, 'offset': 0x87}, 'adc_disable': {'addr': 0x400f, 'bit': 0},
+	             'box_version':0x00fc, 'v1':0x00fd, 'v2':0x00fe, 'v3':0x00ff, 'com_cipher_key':0x4213,
+	             'current_mode': 0x407b, 'channel_a_split_mode': 0x41f5, 'channel_b_split_mode': 0x41f6, 'current_random_mode': 0x4074,
+	             'menu_state': 0x406d, 'execute_command': 0x4070, 'execute_command2': 0x4071}
+
+	execute_commands = {'start_ramp': 0x21}
+
+	refreshPolicies = {'box_version': (ShadowRegisters.STATIC, None), 'v1': (ShadowRegisters.STATIC, None),
+	                   'v2': (ShadowRegisters.STATIC, None), 'v3': (ShadowRegisters.STATIC, None),
+	                   'battery_voltage_boot': (ShadowRegisters.STATIC, None), 'user_modes_loaded': (ShadowRegisters.STATIC, None),
+	                   'psu_voltage': (ShadowRegisters.SLOW, 2.0), 'battery_voltage': (ShadowRegisters.SLOW, 5.0),
+	                   'channel_a_level': (ShadowRegisters.HOT, None), 'channel_b_level': (ShadowRegisters.HOT, None),
+	                   'multiadjust_scaled': (ShadowRegisters.HOT, None), 'current_mode': (ShadowRegisters.HOT, None),
+	                   'multiadjust_min': (ShadowRegisters.MODE, None), 'multiadjust_max': (ShadowRegisters.MODE, None),
+	                   'power_level_range': (ShadowRegisters.MODE, None), 'channel_a_split_mode': (ShadowRegisters.MODE, None),
+	                   'channel_b_split_mode': (ShadowRegisters.MODE, None), 'current_random_mode': (ShadowRegisters.MODE, None)}
+
+	eepromStart = 0x8000
+	eepromSize = 0x200
+	userModesTable = 0x8018 # start module of each user mode, read on each connection to check the cached image
+
+	# polled registers, the ones depending on the current mode are only added when relevant
+	pollRegisters = ('multiadjust_scaled', 'current_mode', 'psu_voltage', 'battery_voltage', 'channel_a_level', 'channel_b_level')
+	modeRegisters = {None: ('multiadjust_min', 'multiadjust_max', 'power_level_range'),
+	                 0x7f: ('channel_a_split_mode', 'channel_b_split_mode'), 0x80: ('current_random_mode',)}
+
+	# registers having side effects, never merged with their neighbours in a multi-byte write
+	uncoalescedRegisters = ('current_mode', 'execute_command', 'execute_command2', 'com_cipher_key')
+
+	commUpdated = Signal()
+	boxCommClosed = Signal()
+	statusUpdated = Signal(int, str)
+	modeChanged = Signal(int)
+	updatePowerRangeLevel = Signal(int)
+	advancedParamsUpdated = Signal()
+	potsOverrideUpdated = Signal(bool)
+	boxInfoUpdated = Signal()       # versions and battery voltage at boot are known
+	userModesUpdated = Signal(int)  # number of user modes loaded in the box
+
+	def __init__(self):
+		self.box = None
+		self.sessionKey = None # encryption key kept for re-opening quickly after link errors
+		self.state = self.CLOSED
+		self.portName = None
+		self.socatRedirector = None
+		self.shadow = ShadowRegisters(self.refreshPolicies)
+		self.linkStats = LinkStats() # kept across the connections
+		self.tracePath = None # file to record the traffic into (see TraceRecorder)
+		self.imageCache = MemoryImageCache()
+		self.eeprom = None # image of the EEPROM, from eepromStart
+		self.paramsValues = self.shadow.values
+		self.writeLatencyBudget = 0.020 # max. delay added by the polling before a write reaches the box (seconds)
+		self.writeLatencies = collections.deque(maxlen=256) # (name, seconds from setValue() to poke)
+		self.peekCost = 0.005
+		self.pollRate = 20.0         # poll cycles per second while the box values are changing
+		self.maxIdleInterval = 0.5   # the polling slows down to this interval (seconds) when nothing changes
+		self.maxPollDelay = 0.1      # the writes keep going first until the polling waited this long (seconds)
+		self.wakeup = threading.Condition()
+		self.registersToWrite = {}
+		self.writeRequestTimes = {}
+		self.displayMessagesToWrite = []
+
+		self.thread = threading.Thread(target=self.worker, name="BoxWorker thread", daemon=True)
+		self.thread.start()
+
+	def open(self, portName):
+		with self.wakeup:
+			self.portName = portName
+			self.wakeup.notify()
+
+	def close(self):
+		with self.wakeup:
+			self.portName = None
+			self.wakeup.notify()
+
+	def stop(self):
+		with self.wakeup:
+			self.state = self.EXITING
+			self.portName = None
+			self.wakeup.notify()
+
+	def applyLatency(self, names=None):
+		""" Estimated time from setValue() to the box receiving the value: median over the last writes (of these registers)
+		of the time to the end of the poke, minus half the recent poke round-trip time. 0 if unknown """
+		samples = sorted(t for name, t in list(self.writeLatencies) if names is None or name in names)
+		if not samples:
+			return 0
+		return max(0, samples[len(samples) // 2] - self.linkStats.recentMean('poke') / 2)
+
+	def getValue(self, name):
+		if name not in self.paramsValues:
+			return float('nan')
+		return self.paramsValues[name]
+
+	def setValue(self, name, value):
+		if name not in self.registers:
+			self.statusUpdated.emit(2, "Register '%s' unknown (bug?)" % (name))
+		else:
+			with self.wakeup:
+				self.writeRequestTimes.setdefault(name, time.time())
+				self.registersToWrite[name] = value
+				self.wakeup.notify()
+
+	def rampStart(self):
+		self.setValue('execute_command', self.execute_commands['start_ramp'])
+
+	def loadEeprom(self, userModesCount):
+		""" Generator returning the EEPROM image, from the disk cache when the box and its user modes table did not change
+		(only these few bytes are read then, the rest of what userModes() needs comes from the image).
+		It yields between the reads (sized like the poll chunks), so it can run in the background. """
+		def readRange(start, end):
+			data = b''
+			while start + len(data) < end:
+				yield
+				count = min(end - start - len(data), max(1, int(self.writeLatencyBudget / self.peekCost)))
+				data+= self.box.dumpMemory(start + len(data), count)
+			return data
+
+		tableStart, tableEnd = self.userModesTable, self.userModesTable + userModesCount
+		table = yield from readRange(tableStart, tableEnd)
+		key = "eeprom-%02x%02x%02x%02x-%d-%08x" % (self.paramsValues['box_version'], self.paramsValues['v1'],
+		                                           self.paramsValues['v2'], self.paramsValues['v3'], userModesCount, zlib.crc32(table))
+		image = self.imageCache.load(key, self.eepromSize)
+		if image is not None and image[tableStart-self.eepromStart:tableEnd-self.eepromStart] == table:
+			return image
+		t = time.time()
+		image = (yield from readRange(self.eepromStart, tableStart)) + table + (yield from readRange(tableEnd, self.eepromStart + self.eepromSize))
+		print("EEPROM read in %.2fs" % (time.time() - t))
+		self.imageCache.save(key, image)
+		return image
+
+	@classmethod
+	def userModes(cls, eeprom, count):
+		""" Returns the (start module, program block address) of each user mode, from the EEPROM image """
+		def byte(address):
+			offset = address - cls.eepromStart
+			return eeprom[offset] if 0 <= offset < len(eeprom) else 0
+
+		modes = []
+		for i in range (0,count):
+			startmodule = byte(0x8018+i)
+			if (startmodule < 0xa0):
+				programblockstart = 0x8040+byte(0x8000+startmodule-0x60)
+			else:
+				programblockstart = 0x8100+byte(0x8000+startmodule-0xa0)
+			modes.append((startmodule, programblockstart))
+		return modes
+
+	def planRegisterWrites(self, writes):
+		""" Groups the pending writes of adjacent plain registers into runs of up to 8 bytes.
+		Returns the runs as (startAddress, names, values) and the names to write one by one. """
+		plain, others = [], []
+		for name in writes:
+			if type(self.registers[name]) == dict or name in self.uncoalescedRegisters:
+				others.append(name)
+			else:
+				plain.append((self.registers[name], name))
+
+		runs = []
+		for addr, name in sorted(plain):
+			if runs and runs[-1][0] + len(runs[-1][1]) == addr and len(runs[-1][1]) < 8:
+				runs[-1][1].append(name)
+				runs[-1][2].append(writes[name])
+			else:
+				runs.append((addr, [name], [writes[name]]))
+		return runs, others
+
+	def worker(self):
+		def writeRegisterToBox(name, requestedValue):
+			if type(self.registers[name]) == dict:
+				addr = self.registers[name]['addr']
+				if 'bit' in self.registers[name]:
+					bit = self.registers[name]['bit']
+					value = self.box.peek(addr)
+					value&= ~(1 << bit)
+					if requestedValue:
+						value|= 1 << bit
+				else:
+					value = requestedValue
+			else:
+				addr = self.registers[name]
+				value = requestedValue
+
+			print(name, addr, value)
+			if name == 'current_mode' and self.modes[value] == "None":
+				value = 0x90
+				# so let's get it into a blank empty mode. easiest way is calltable 18
+				self.box.poke(0x4078, [0x90]) # mode 90 doesn't exist
+				self.box.execute(18, raiseOnTimeout=False) # execute mode 90, best effort
+				for base in [0x4000,0x4100]:
+					# init
+					self.box.poke(base+0xa8, [0,0]) # don't increment channel intensity
+					self.box.poke(base+0xa5, [128]) # A intensity mod value = min
+					self.box.poke(base+0xac, [0]) # no select
+					self.box.poke(base+0xb1, [0]) # rate
+					self.box.poke(base+0xae, [0x64]) # freq mod
+					self.box.poke(base+0xb5, [4]) # select normal parms
+					self.box.poke(base+0xb7, [0xc8]) # width mod value
+					self.box.poke(base+0xba, [0]) # width mod value
+					self.box.poke(base+0xbe, [4]) # select normal parms
+					self.box.poke(base+0x9c, [255]) # ramp off
+
+					# actuated
+					# ~ self.box.poke(base+0xac, [0]) # no select
+				self.overWriteDisplay("None")
+				writeDone(name, requestedValue)
+				return
+
+			self.box.poke(addr, [value])
+			self.shadow.expire(name)
+			writeDone(name, requestedValue)
+
+			if name == 'current_mode':
+				# best effort, the write is done anyway
+				self.box.execute(0x4, [0x12], raiseOnTimeout=False)
+
+		def writeDone(name, value):
+			# setValue() is called from other threads, a value set between the compare and the delete would be lost
+			with self.wakeup:
+				t = self.writeRequestTimes.pop(name, None)
+				if t is not None:
+					self.writeLatencies.append((name, time.time() - t))
+				if value == self.registersToWrite[name]:
+					del self.registersToWrite[name]
+				else:
+					# changed again in the meantime, this newer value is still waiting
+					self.writeRequestTimes.setdefault(name, time.time())
+
+		def writeRegistersToBox():
+			with self.wakeup:
+				writes = self.registersToWrite.copy()
+			runs, others = self.planRegisterWrites(writes)
+			advancedParamsWritten = False
+			for addr, names, values in runs:
+				print(', '.join(names), addr, values)
+				self.box.poke(addr, values)
+				for name, value in zip(names, values):
+					advancedParamsWritten|= name.startswith("advparam_")
+					self.shadow.expire(name)
+					writeDone(name, value)
+
+			if advancedParamsWritten:
+				self.box.execute(0x20)
+
+			for name in others:
+				writeRegisterToBox(name, self.registersToWrite[name])
+
+		def registerAddress(name):
+			if type(self.registers[name]) == dict:
+				return self.registers[name]['addr']
+			return self.registers[name]
+
+		def decodeParamValue(name, value):
+			if type(self.registers[name]) == dict:
+				if 'bit' in self.registers[name]:
+					value = value & (1 << self.registers[name]['bit'])
+
+				elif 'offset' in self.registers[name]:
+					value = value - self.registers[name]['offset']
+
+			self.shadow.store(name, value)
+			return value
+
+		def storeParamValue(name):
+			return decodeParamValue(name, self.box.peek(registerAddress(name)))
+
+		def storeParamValues(*names):
+			t = time.time()
+			values = self.box.peekMany([registerAddress(name) for name in names])
+			self.peekCost = 0.8 * self.peekCost + 0.2 * (time.time() - t) / len(names)
+			return [decodeParamValue(name, value) for name, value in zip(names, values)]
+
+		def refreshStaleParamValues(*names):
+			names = self.shadow.stale(names)
+			if names:
+				storeParamValues(*names)
+			return names
+
+		def pollCycle():
+			""" Refreshes the stale registers, yielding between each batch of reads so pending writes can go first """
+			nonlocal lastMode, pollInterval
+			previousValues = {name: self.paramsValues.get(name) for name in self.pollRegisters}
+
+			def refreshInChunks(names):
+				names = self.shadow.stale(names)
+				while names:
+					# as many reads as fit in the latency budget of a write arriving meanwhile
+					chunkSize = max(1, int(self.writeLatencyBudget / self.peekCost))
+					storeParamValues(*names[:chunkSize])
+					names = names[chunkSize:]
+					yield
+
+			# ~ storeParamValue("current_sense") # ADC0
+			# psu_voltage: ADC2, battery_voltage: ADC3, channel_a_level: ADC4, channel_b_level: ADC5
+			yield from refreshInChunks(self.pollRegisters)
+			currentmode = self.paramsValues["current_mode"]
+			if currentmode != lastMode:
+				self.shadow.invalidate(ShadowRegisters.MODE)
+				# the box redraws its display when the mode changes
+				self.lcdShadow.clear()
+
+			powerLevelRangeStale = self.shadow.isStale("power_level_range")
+			yield from refreshInChunks(self.modeRegisters[None] + self.modeRegisters.get(currentmode, ()))
+			if powerLevelRangeStale:
+				self.updatePowerRangeLevel.emit(self.paramsValues["power_level_range"])
+
+			if currentmode != lastMode:
+				self.modeChanged.emit(currentmode)
+				lastMode = currentmode
+
+				# ~ if (currentmode == 0x80):
+					# ~ timeleft = self.box.peek(0x4075) - self.box.peek(0x406a)
+					# ~ if (timeleft<0):
+						# ~ timeleft+=256
+					# ~ print("\tTime until change mode\t: {0:#d} seconds ".format(int(timeleft/1.91)))
+				# ~ print("\tMode has been running\t: {0:#d} seconds".format(int((self.box.peek(0x4089)+self.box.peek(0x408a)*256)*1.048)))
+
+			if any(self.paramsValues.get(name) != value for name, value in previousValues.items()):
+				pollInterval = 1.0 / self.pollRate
+			else:
+				# nothing is moving, let the link rest a bit longer each time
+				pollInterval = min(pollInterval * 1.5, self.maxIdleInterval)
+
+			self.commUpdated.emit()
+
+			# ~ storeParamValue('advparam_ramp_level')
+			# ~ storeParamValue('advparam_ramp_time')
+			# ~ storeParamValue('advparam_depth')
+			# ~ storeParamValue('advparam_tempo')
+			# ~ storeParamValue('advparam_frequency')
+			# ~ storeParamValue('advparam_effect')
+			# ~ storeParamValue('advparam_width')
+			# ~ storeParamValue('advparam_pace')
+			# ~ advancedParamsUpdated.emit()
+
+		def overWriteDisplay(text, posOffset=None):
+			""" Writes the text on the LCD, yielding after each character so it never delays other transactions.
+			Without a position, the LCD is cleared first and the blanks are not sent again. """
+			if posOffset is None:
+				self.box.poke(0x4180, [0x64])
+				self.box.execute(0x15)
+				self.lcdShadow = dict.fromkeys(list(range(0, 16)) + list(range(64, 80)), ' ')
+				yield
+
+				posOffset = 9 if len(text) < 8 else 8
+			else:
+				# the box redraws its display by itself (menus, knobs...) without us knowing, what was
+				# written before may not be there anymore and an explicit write must always happen
+				self.lcdShadow.clear()
+
+			if posOffset == 0:
+				self.box.poke(self.registers["menu_state"], [1])
+
+			changes = [(pos+posOffset, char) for pos, char in enumerate(text) if self.lcdShadow.get(pos+posOffset) != char]
+
+			# the display routine of the box only takes one character (and its position) at a time
+			for pos, char in changes:
+				self.box.poke(0x4180, [ord(char), pos])
+				self.box.execute(0x13)
+				self.lcdShadow[pos] = char
+				yield
+
+		def bringUp():
+			""" Reads what the controls don't need right away, a few registers at a time, when the link is idle """
+			# static registers are still known when re-opening after errors
+			refreshStaleParamValues("battery_voltage_boot", "box_version", "v1", "v2", "v3")
+			self.boxInfoUpdated.emit()
+			yield
+
+			# (also when reading the EEPROM was interrupted)
+			if refreshStaleParamValues("user_modes_loaded") or (self.paramsValues["user_modes_loaded"] and self.eeprom is None):
+				yield
+				userModes = []
+				if self.paramsValues["user_modes_loaded"]:
+					self.eeprom = yield from self.loadEeprom(self.paramsValues["user_modes_loaded"])
+					userModes = self.userModes(self.eeprom, self.paramsValues["user_modes_loaded"])
+				for i, (startmodule, programblockstart) in enumerate(userModes):
+					print("\tUser %d is module 0x%02x\t: 0x%04x (eeprom)"%(i+1,startmodule,programblockstart))
+				self.userModesUpdated.emit(len(userModes))
+				yield
+
+			storeParamValues('advparam_ramp_level', 'advparam_ramp_time', 'advparam_depth', 'advparam_tempo',
+			                 'advparam_frequency', 'advparam_effect', 'advparam_width', 'advparam_pace')
+			self.advancedParamsUpdated.emit()
+
+			self.statusUpdated.emit(1, "Connected and synchronised!" + (" (session resumed)" if self.box.resumed else ""))
+
+		def step(task):
+			""" Runs a generator until its next yield, returns False once it has finished """
+			try:
+				next(task)
+				return True
+			except StopIteration:
+				return False
+
+		def lcdStep(lcd):
+			if lcd is None and len(self.displayMessagesToWrite):
+				lcd = overWriteDisplay(*self.displayMessagesToWrite.pop(0))
+			if lcd is not None and not step(lcd):
+				lcd = None
+			return lcd
+
+		print("Starting BoxWorker.worker()")
+		self.lcdShadow = {} # {position: character} known to be on the LCD, 0-15 for the 1st line, 64-79 for the 2nd
+		self.errorCounter = 0
+		lastMode = None
+		poll, lcd, background = None, None, None
+		pollInterval, nextPollTime, lastPollStep = 0, 0, 0
+
+		while(self.state != self.EXITING):
+			if self.state == self.CLOSED:
+				if self.portName != None:
+					self.state = self.OPENING
+					continue
+				with self.wakeup:
+					if self.portName == None and self.state == self.CLOSED:
+						self.wakeup.wait(0.5)
+
+			elif self.state == self.CLOSING:
+				try:
+					writeRegistersToBox()
+					self.box.close()
+					self.sessionKey = None
+					self.shadow.clear()
+					self.state = self.CLOSED
+					self.statusUpdated.emit(1, "Port closed.")
+					self.boxCommClosed.emit()
+				except Exception as e:
+					self.statusUpdated.emit(3, str(e))
+
+			elif self.state == self.OPENING:
+				if self.portName == None:
+					self.statusUpdated.emit(1, "Aborting etablishing connection...")
+					self.shadow.clear()
+					self.state = self.CLOSED
+					continue
+
+				self.registersToWrite = {}
+				self.writeRequestTimes = {}
+				self.displayMessagesToWrite = []
+				self.lcdShadow.clear()
+				poll, lcd, background = None, None, None
+				pollInterval, nextPollTime, lastPollStep = 1.0 / self.pollRate, 0, 0
+				try:
+					host, port, encrypted = parsePortName(self.portName)
+					if host is not None:
+						link = NetworkLink(host, port=port)
+					else:
+						link = SerialLink(self.portName)
+					if self.tracePath is not None:
+						link = TraceRecorder(link, self.tracePath)
+					self.box = MK312(link, encrypted=encrypted, sessionKey=self.sessionKey if encrypted else None, stats=self.linkStats)
+					if self.box.encryptionEnabled:
+						self.sessionKey = self.box.encryptionKey
+					self.state = self.CONNECTED
+					self.errorCounter = 0
+					with self.wakeup:
+						# the writes requested while connecting don't tell anything about the latency of the link
+						for name in self.writeRequestTimes:
+							self.writeRequestTimes[name] = time.time()
+
+					# only what the controls need, the rest is read in the background once they are live
+					powerLevelRange, potsOverride = storeParamValues("power_level_range", "adc_disable")
+					self.updatePowerRangeLevel.emit(powerLevelRange)
+					self.potsOverrideUpdated.emit(potsOverride)
+					self.statusUpdated.emit(1, "Connected, synchronising...")
+					background = bringUp()
+					lastMode = None
+
+				except Exception as e:
+					self.sessionKey = None
+					self.errorCounter+=1
+					self.linkStats.count('open_failures')
+					msg = str(e)
+					if self.errorCounter < 4:
+						self.statusUpdated.emit(2, msg)
+					else:
+						msg+="\nCannot synchronise with mk312... "
+						if "received no reply" in msg:
+							msg+="Is the box connected and powered on?"
+						else:
+							msg+="Try to turn off the box and on again?"
+						self.statusUpdated.emit(3, msg)
+					time.sleep(.2)
+
+			elif self.state == self.CONNECTED:
+				if self.portName == None:
+					self.state = self.CLOSING
+					continue
+
+				try:
+					# one step at a time: queued writes first, then telemetry, and the LCD with the remaining time
+					# a continuous stream of writes still leaves a poll step every maxPollDelay
+					now = time.time()
+					pollWaiting = now - (lastPollStep if poll is not None else nextPollTime)
+					if len(self.registersToWrite) and pollWaiting < self.maxPollDelay:
+						writeRegistersToBox()
+						# show the effect of the write soon
+						pollInterval = 1.0 / self.pollRate
+						nextPollTime = min(nextPollTime, time.time() + pollInterval)
+					elif poll is not None:
+						lastPollStep = now
+						if not step(poll):
+							poll = None
+							# at least one character per cycle, even when the link has no idle time
+							lcd = lcdStep(lcd)
+					elif now >= nextPollTime:
+						# waiting since it was due
+						lastPollStep, nextPollTime = nextPollTime, now + pollInterval
+						poll = pollCycle()
+					elif lcd is not None or len(self.displayMessagesToWrite):
+						lcd = lcdStep(lcd)
+					elif background is not None:
+						try:
+							if not step(background):
+								background = None
+						except Exception as e:
+							# a generator can't go on after raising, what it had left to read would be lost:
+							# start it again on the next idle step (what it already got is not read again)
+							print("Synchronisation interrupted: %s" % (str(e)))
+							background = bringUp()
+							raise
+					else:
+						with self.wakeup:
+							if not len(self.registersToWrite) and not len(self.displayMessagesToWrite) and self.portName != None:
+								self.wakeup.wait(max(0, nextPollTime - time.time()))
+
+					self.errorCounter = 0
+				except Exception as e:
+					self.errorCounter+=1
+					self.statusUpdated.emit(3, str(e))
+					if self.errorCounter % 5 == 0:
+						self.linkStats.count('reconnects')
+						try:
+							 # important or the MK312 object is not deleted
+							# the key is kept on the box so the session can be resumed
+							self.box.close(resetKey=False)
+							self.box = None
+						except Exception as e:
+							print(str(e))
+						self.state = self.OPENING
+
+		try:
+			# if possible, reset the key and close the interface
+			self.box.close()
+		except:
+			pass
+		print("BoxWorker ended")
+
+	def overWriteDisplay(self, text, posOffset=None, line=None):
+		if posOffset is None and line is not None:
+			posOffset = 0
+		if line==2: posOffset+=64
+		with self.wakeup:
+			self.displayMessagesToWrite.append((text, posOffset))
+			self.wakeup.notify()
+
+
+class MK312():
+	# code is working only if it is set to zero, but does not seems to break the connection
+	hostKey = 0x00          # The key sent by us, 0 for simplicity
+	extraEncryptKey = 0x55  # The key always added to the encryption
+
+	def __init__(self, link, encrypted=True, sessionKey=None, stats=None):
+		self.link = link                   # the Communication layer to the device
+		self.encryptionEnabled = encrypted # do we use the Encryptionless method or not
+		self.needHandshake = True
+		self.rtt = 0.01                    # measured peek round-trip time (seconds)
+		self.resumed = False
+		self.stats = stats if stats is not None else LinkStats()
+		self.tracing = hasattr(link, 'recordCall') # the link is a TraceRecorder
+
+		start = time.time()
+		if self.tracing: self.link.recordCall('open', encrypted, sessionKey)
+		resuming = sessionKey is not None and self.encryptionEnabled
+		# when resuming, stale bytes only make the first peek fail, and the input is flushed then
+		if not resuming:
+			self._flushInputBuffer()
+		else:
+			self.resumed = self._resumeSession(sessionKey)
+		if not self.resumed:
+			self._handshake()
+			if resuming:
+				# the box may still have the old key, the negotiation would fail until it is powered off
+				self._resetKey(sessionKey)
+			self._negotiateKeys()
+			if self.tracing: self.link.recordKey(self._sessionKey())
+		self.stats.record('resume' if self.resumed else 'open', time.time() - start)
+
+	def _resumeSession(self, key):
+		""" Tries to talk with a key negotiated before (the box keeps it until it is reset or powered off) """
+		self.encryptionKey = key
+		if self.tracing: self.link.recordKey(key)
+		self.needHandshake = False
+		try:
+			self._write([0x3c, 0x00, 0xfc]) # box_version
+			data = self._read(3)
+			if data[0] == 0x22:
+				return True
+		except Exception as e:
+			print("Session resume failed:", str(e))
+		self.needHandshake = True
+		try:
+			self._flushInputBuffer()
+		except Exception as e:
+			print(str(e))
+		return False
+
+	def _resetKey(self, key):
+		""" Resets com_cipher_key, in case the box still uses the given key """
+		self.encryptionKey = key
+		if self.tracing: self.link.recordKey(key)
+		try:
+			self._write(self._pokeCommand(0x4213, [0x0]))
+			self.link.recv(1)
+			self._flushInputBuffer()
+		except Exception as e:
+			print(str(e))
+
+	def _flushInputBuffer(self):
+		attempts = 0
+		while (True):
+			s = self.link.recv(1024)
+			if not s:
+				break
+			attempts+=1
+			print("Flushed:", s)
+			if attempts > 5:
+				s = str(s)
+				if len(s) > 20:
+					s = s[:20] + '...'
+				raise Exception("Device doesn't stop sending bytes (%s)" % (s))
+
+	def _handshake(self):
+		""" Attempts the handshake with the MK312 device """
+		attempts = 0
+		ok = 0
+		start = time.time()
+		while (True):
+			self.link.send(bytes([0x00])) # Send a 0 as a hello
+			time.sleep(getattr(self.link, 'helloDelay', 0.1))
+			reply = self.link.recv(1)
+			if (len(reply) == 1 and reply[0] == 0x07):
+				ok+=1
+				if ok > 2:
+					self.needHandshake = False
+					self.stats.record('handshake', time.time() - start)
+					break
+				continue
+			ok=0
+			attempts+=1
+			if (attempts > 12):
+				self.stats.count('handshake_failures')
+				raise Exception("Handshake with device failed")
+
+	def _negotiateKeys(self):
+		""" Do the key handshake with the device """
+
+		# this encryptionless mode is only supported by RexLabs Wifi adapter
+		# (https://github.com/Rangarig/MK312WIFI/)
+		if (not self.encryptionEnabled):
+			self.link.send(bytes((0x2f, 0x42, 0x42)))
+			rx = self.link.recv(100)
+			if len(rx) != 1 or rx[0] != 0x69: raise Exception("Failed to establish non encrypted mode")
+			return
+
+		# Send key negotiation
+		while True:
+			self.link.send(self._encode((0x2f, self.hostKey)))
+			data = self._read(3) # this does the checksum validation
+			if len(data) == 2:
+				break
+
+		boxkey = data[1]
+		self.encryptionKey = (boxkey ^ self.hostKey ^ self.extraEncryptKey)
+
+	@staticmethod
+	def _encode(data, key=None):
+		""" Appends the checksum to a packet and encrypts it if a key is given """
+		data = list(data) + [sum(data) % 256]
+		if key is not None:
+			data = [x ^ key for x in data]
+		return bytes(data)
+
+	@staticmethod
+	def _decode(data):
+		""" Checks and removes the checksum of a reply """
+		data, checksum = data[:-1], data[-1]
+		computedChecksum = sum(data) % 256
+		if computedChecksum != checksum:
+			raise Exception("Checksum mismatch! (%s %02x, computed %02x)" % (data.hex(), checksum, computedChecksum))
+		return data
+
+	@staticmethod
+	def _pokeCommand(startAddress, data):
+		if type(data) is not list:
+			raise TypeError("data must be a list")
+		length = len(data)
+		if length == 0 or length > 8:
+			raise Exception("Can only write between 1-8 bytes")
+		return [0x0d | ((length+3) << 4), startAddress >> 8, startAddress & 0xff] + data
+
+	def _sessionKey(self):
+		return self.encryptionKey if self.encryptionEnabled else None
+
+	def _write(self, data):
+		self.link.send(self._encode(data, self._sessionKey()))
+
+	def _read(self, length):
+		if hasattr(self.link, 'recvExactly'):
+			data = self.link.recvExactly(length, timeout=0.5)
+		else:
+			data = self._readSlowly(length)
+
+		if len(data) < length:
+			self.needHandshake = True
+			self.stats.count('short_reads')
+			raise Exception("Unable to receive all the requested bytes (%d < %d)" % (len(data), length))
+
+		try:
+			return self._decode(data)
+		except Exception:
+			self.needHandshake = True
+			self.stats.count('checksum_mismatches')
+			raise
+
+	def _readSlowly(self, length):
+		start = time.time()
+		data = self.link.recv(length)
+
+		# this is a workaround for MK312-WIFI firmware prior to v1.2.02 (sending a packet per byte)
+		while len(data) < length and time.time() < start + 0.5:
+			data+= self.link.recv(length-len(data))
+		return data
+
+	def peek(self, address):
+		if self.tracing: self.link.recordCall('peek', address)
+		if self.needHandshake:
+			self.stats.count('rehandshakes')
+			self._handshake()
+
+		start = time.time()
+		self._write([0x3c, address >> 8, address & 0xff])
+		data = self._read(3)
+		elapsed = time.time() - start
+		self.rtt = 0.9 * self.rtt + 0.1 * elapsed
+		self.stats.record('peek', elapsed)
+		return data[1]
+
+	def peekMany(self, addresses, window=8):
+		""" Reads several addresses, keeping up to 'window' requests in flight """
+		addresses = list(addresses)
+		if self.tracing: self.link.recordCall('peekMany', addresses, window)
+		values = []
+		retried = False
+		while len(values) < len(addresses):
+			if self.needHandshake:
+				self.stats.count('rehandshakes')
+				self._handshake()
+
+			pending = addresses[len(values):len(values)+window]
+			start = time.time()
+			for address in pending:
+				self._write([0x3c, address >> 8, address & 0xff])
+
+			outstanding = len(pending)
+			try:
+				for address in pending:
+					outstanding-= 1
+					data = self._read(3)
+					values.append(data[1])
+				self.stats.record('peek_window', time.time() - start)
+			except Exception as e:
+				# the replies still in flight are now meaningless, so the link
+				# has to be drained before the next handshake can succeed
+				self._drainReplies(outstanding)
+				if retried:
+					raise(e)
+				print("peekMany: %s, resynchronising" % (str(e)))
+				retried = True
+		return values
+
+	def dumpMemory(self, start, length, chunkSize=64):
+		""" Reads a whole address range with pipelined peeks, returns it as bytes """
+		data = bytearray()
+		# a transmission error only costs the chunk it happened in
+		for address in range(start, start + length, chunkSize):
+			data+= bytes(self.peekMany(range(address, min(address + chunkSize, start + length))))
+		return bytes(data)
+
+	def _drainReplies(self, outstanding):
+		""" Drops the replies still coming after a failed peek window """
+		start = time.time()
+		try:
+			if hasattr(self.link, 'recvExactly'):
+				# the replies still in flight come within a round-trip each, no need for the long flush
+				self.link.recvExactly(3 * outstanding, timeout=self.rtt * (outstanding + 1))
+				attempts = 0
+				while self.link.recvExactly(1024, timeout=max(self.rtt, 0.05)):
+					attempts+= 1
+					if attempts > 5:
+						raise Exception("Device doesn't stop sending bytes")
+			else:
+				self._flushInputBuffer()
+		except Exception as e:
+			print(str(e))
+		self.stats.record('drain', time.time() - start)
+
+	def poke(self, startAddress, data):
+		if not self.link: return
+		if self.tracing: self.link.recordCall('poke', startAddress, data)
+
+		if self.needHandshake:
+			self.stats.count('rehandshakes')
+			self._handshake()
+
+		start = time.time()
+		self._write(self._pokeCommand(startAddress, data))
+
+		ackCode = self.link.recv(1)
+		self.stats.record('poke', time.time() - start)
+		if not ackCode:
+			self.stats.count('short_reads')
+		elif ackCode[0] != 0x06:
+			self.stats.count('poke_errors')
+		return ackCode
+
+	def execute(self, command, args=(), timeout=1.0, raiseOnTimeout=True):
+		""" Writes execute_command (and execute_command2...) then waits for the box to complete it.
+		Returns the elapsed time, raises an exception on timeout (or only logs it and returns None) """
+		start = time.time()
+		self.poke(0x4070, [command] + list(args))
+
+		# the peek itself costs a round-trip, so wait in steps proportional to it
+		delay = self.rtt / 2
+		while self.peek(0x4070) != 0xff:
+			if time.time() - start > timeout:
+				self.stats.count('execute_timeouts')
+				self.stats.count('execute_timeouts 0x%02x' % (command))
+				msg = "Command 0x%02x not completed after %.2fs" % (command, time.time() - start)
+				if raiseOnTimeout:
+					raise Exception(msg)
+				print(msg)
+				return None
+			time.sleep(delay)
+			delay = min(delay * 2, self.rtt * 4)
+
+		elapsed = time.time() - start
+		self.stats.record('execute', elapsed)
+		# also per command, the slow ones would be hidden in the total
+		self.stats.record('execute 0x%02x' % (command), elapsed)
+		return elapsed
+
+	def close(self, resetKey=True):
+		if self.encryptionEnabled and resetKey:
+			self.poke(0x4213, [0x0]) # reset key
+		self.link = None
+
+
+class ReceiveBuffer():
+	""" Preallocated buffer the links receive into, the bytes are only copied out when a reply is complete """
+	def __init__(self, size=4096):
+		self.buffer = bytearray(size)
+		self.view = memoryview(self.buffer)
+		self.start, self.end = 0, 0
+
+	def __len__(self):
+		return self.end - self.start
+
+	def free(self):
+		""" Returns a writable view of the free space, moving the pending bytes to the start if needed """
+		if self.start == self.end:
+			self.start, self.end = 0, 0
+		elif self.end == len(self.buffer):
+			pending = self.end - self.start
+			self.view[:pending] = self.view[self.start:self.end]
+			self.start, self.end = 0, pending
+		return self.view[self.end:]
+
+	def filled(self, count):
+		self.end+= count
+
+	def take(self, length):
+		length = min(length, len(self))
+		data = bytes(self.view[self.start:self.start+length])
+		self.start+= length
+		return data
+
+
+class NetworkLink():
+	def __init__(self, ip, port, debug=False):
+		self.debug = debug
+		self.timeout = 0.5
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.settimeout(self.timeout)
+		self.socket.connect((ip, port))
+		# the protocol is made of tiny request/reply packets, don't let them wait for each other
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.rxBuffer = ReceiveBuffer()
+
+	def send(self, data):
+		if self.debug: print("send", data.hex())
+		self.socket.sendall(data)
+
+	def _fill(self, timeout):
+		""" Gets everything already received (waiting up to timeout for something) with a single syscall """
+		if timeout != self.timeout:
+			self.timeout = timeout
+			self.socket.settimeout(timeout)
+		try:
+			count = self.socket.recv_into(self.rxBuffer.free())
+		except (TimeoutError, socket.timeout):
+			return 0
+		self.rxBuffer.filled(count)
+		return count
+
+	def recv(self, length=1):
+		if not len(self.rxBuffer):
+			self._fill(0.5)
+		data = self.rxBuffer.take(length)
+		if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
+		return data
+
+	def recvExactly(self, length, timeout):
+		deadline = time.time() + timeout
+		while len(self.rxBuffer) < length:
+			remaining = deadline - time.time()
+			if remaining <= 0 or not self._fill(remaining):
+				break
+		data = self.rxBuffer.take(length)
+		if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
+		return data
+
+
+class SerialLink():
+	# the timeout of the port never changes (pyserial reconfigures the port for that),
+	# the longer waits are done with several reads
+	readTimeout = 0.05
+
+	def __init__(self, port, baudrate=19200, debug=False):
+		self.debug = debug
+		if self.debug: print("opening serial port", port)
+		self.serial = serial.Serial(port, baudrate, timeout=self.readTimeout, parity=serial.PARITY_NONE, bytesize=8, stopbits=1, xonxoff=0, rtscts=0)
+		if fcntl is not None:
+			fcntl.flock(self.serial.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		self.rxBuffer = ReceiveBuffer()
+
+	def send(self, data):
+		if self.debug: print("send", data.hex())
+		self.serial.write(data)
+
+	def _fill(self, needed, timeout):
+		""" Reads at least the needed bytes (unless timed out) and anything else already waiting """
+		deadline = time.time() + timeout
+		count = 0
+		while True:
+			free = self.rxBuffer.free()
+			received = self.serial.readinto(free[:min(len(free), max(needed - count, self.serial.in_waiting))])
+			self.rxBuffer.filled(received)
+			count+= received
+			if count >= needed or time.time() >= deadline:
+				return count
+
+	def recv(self, length=1):
+		if not len(self.rxBuffer):
+			self._fill(length, 0.2)
+		data = self.rxBuffer.take(length)
+		if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
+		return data
+
+	def recvExactly(self, length, timeout):
+		if len(self.rxBuffer) < length:
+			self._fill(length - len(self.rxBuffer), timeout)
+		data = self.rxBuffer.take(length)
+		if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
+		return data
+
+	def __del__(self):
+		if self.debug: print("serial port closed.")
+		self.serial.close()
+		del self.serial
+
+
+class TraceRecorder():
+	""" Wraps a link and appends everything going through it to a binary trace file: the raw (encrypted) bytes,
+	the keys, and the MK312 calls, so that TraceReplayLink can play the session again exactly.
+	Each record is a header (timestamp as double, type, payload length) followed by the payload. """
+	magic = b'MK312TRACE\x01\n'
+	header = struct.Struct('<dBH')
+	TX = 1    # bytes sent
+	RX = 2    # bytes returned by a recv() call (can be empty when it timed out)
+	KEY = 3   # encryption key in use from now on (empty payload when not encrypted)
+	CALL = 4  # MK312 call, as a JSON list [method, args...]
+
+	def __init__(self, link, path):
+		self.link = link
+		# unbuffered: a record is a single write() and the file is complete if we crash
+		self.file = open(path, 'ab', buffering=0)
+		if self.file.tell() == 0:
+			self.file.write(self.magic)
+
+	def _record(self, recordType, payload):
+		self.file.write(self.header.pack(time.time(), recordType, len(payload)) + payload)
+
+	def send(self, data):
+		self.link.send(data)
+		self._record(self.TX, data)
+
+	def recv(self, length=1):
+		data = self.link.recv(length)
+		self._record(self.RX, data)
+		return data
+
+	def recvExactly(self, length, timeout):
+		data = self.link.recvExactly(length, timeout)
+		self._record(self.RX, data)
+		return data
+
+	def recordKey(self, key):
+		self._record(self.KEY, bytes([key]) if key is not None else b'')
+
+	def recordCall(self, *call):
+		self._record(self.CALL, json.dumps(call).encode())
+
+	def __del__(self):
+		self.file.close()
+
+
+class TraceReader():
+	""" Memory-maps a trace file written by TraceRecorder """
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.map[:len(TraceRecorder.magic)] != TraceRecorder.magic:
+			raise Exception("%s is not a MK312 trace file" % (path))
+
+	def records(self):
+		""" Yields (timestamp, type, payload) for each record """
+		header = TraceRecorder.header
+		offset = len(TraceRecorder.magic)
+		while offset + header.size <= len(self.map):
+			timestamp, recordType, length = header.unpack_from(self.map, offset)
+			offset+= header.size
+			if offset + length > len(self.map):
+				break # truncated by a crash
+			yield timestamp, recordType, self.map[offset:offset+length]
+			offset+= length
+
+	def sessions(self):
+		""" Splits the trace in connections, each starting with the 'open' call of a MK312 """
+		session = None
+		for record in self.records():
+			if record[1] == TraceRecorder.CALL and json.loads(record[2])[0] == 'open':
+				if session is not None:
+					yield session
+				session = []
+			if session is not None:
+				session.append(record)
+		if session is not None:
+			yield session
+
+
+class TraceReplayLink():
+	""" Fake link giving back the bytes received in a recorded session. The sent bytes have to be the recorded ones. """
+	helloDelay = 0 # the replies are already there, no need to wait during the handshakes
+
+	def __init__(self, records):
+		self.txRecords = collections.deque(r[2] for r in records if r[1] == TraceRecorder.TX)
+		self.rxRecords = collections.deque(r[2] for r in records if r[1] == TraceRecorder.RX)
+		self.txCount = 0
+
+	def send(self, data):
+		if not self.txRecords:
+			raise Exception("Replay went past the end of the trace")
+		expected = self.txRecords.popleft()
+		if bytes(data) != expected:
+			raise Exception("Replay diverged after %d packets: sent %s, recorded %s" % (self.txCount, bytes(data).hex(), expected.hex()))
+		self.txCount+= 1
+
+	def recv(self, length=1):
+		return self.rxRecords.popleft() if self.rxRecords else b''
+
+	def recvExactly(self, length, timeout):
+		return self.recv(length)
+
+
+def replayTrace(path, verbose=False):
+	""" Plays the MK312 calls of a trace again, against the recorded replies. Returns the number of calls replayed. """
+	calls = 0
+	for session in TraceReader(path).sessions():
+		link = TraceReplayLink(session)
+		box = None
+		for timestamp, recordType, payload in session:
+			if recordType != TraceRecorder.CALL:
+				continue
+			method, *args = json.loads(payload)
+			try:
+				if method == 'open':
+					box = MK312(link, *args)
+				else:
+					result = getattr(box, method)(*args)
+					if verbose: print("%.3f %s%s -> %s" % (timestamp, method, tuple(args), result))
+			except Exception as e:
+				# the recorded session may have failed the same way
+				print("%.3f %s%s: %s" % (timestamp, method, tuple(args), str(e)))
+			calls+= 1
+	return calls
+
+
+class AsyncMK312():
+	""" asyncio version of MK312, for driving several boxes (or other services) from the same event loop.
+	Use 'box = await AsyncMK312.open(link)' as the connection needs I/O. """
+
+	def __init__(self, link, encrypted=True):
+		self.link = link
+		self.encryptionEnabled = encrypted
+		self.encryptionKey = None
+		self.needHandshake = True
+		self.lock = asyncio.Lock() # one transaction at a time on the link
+
+	@classmethod
+	async def open(cls, link, encrypted=True):
+		box = cls(link, encrypted)
+		await box._flushInputBuffer()
+		await box.handshake()
+		await box._negotiateKeys()
+		return box
+
+	async def _flushInputBuffer(self):
+		for attempts in range(6):
+			if not await self.link.recv(1024):
+				return
+		raise Exception("Device doesn't stop sending bytes")
+
+	async def handshake(self):
+		""" Attempts the handshake with the MK312 device """
+		attempts = 0
+		ok = 0
+		while (True):
+			await self.link.send(bytes([0x00])) # Send a 0 as a hello
+			reply = await self.link.recv(1, timeout=0.1)
+			if (len(reply) == 1 and reply[0] == 0x07):
+				ok+=1
+				if ok > 2:
+					self.needHandshake = False
+					break
+				continue
+			ok=0
+			attempts+=1
+			if (attempts > 12): raise Exception("Handshake with device failed")
+
+	async def _negotiateKeys(self):
+		if (not self.encryptionEnabled):
+			await self.link.send(bytes((0x2f, 0x42, 0x42)))
+			rx = await self.link.recv(100)
+			if len(rx) != 1 or rx[0] != 0x69: raise Exception("Failed to establish non encrypted mode")
+			return
+
+		while True:
+			await self.link.send(MK312._encode((0x2f, MK312.hostKey)))
+			data = await self._read(3)
+			if len(data) == 2:
+				break
+		self.encryptionKey = (data[1] ^ MK312.hostKey ^ MK312.extraEncryptKey)
+
+	async def _write(self, data):
+		await self.link.send(MK312._encode(data, self.encryptionKey if self.encryptionEnabled else None))
+
+	async def _read(self, length, timeout=0.5):
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + timeout
+		data = b""
+		while len(data) < length and loop.time() < deadline:
+			data+= await self.link.recv(length-len(data), timeout=deadline-loop.time())
+
+		if len(data) < length:
+			self.needHandshake = True
+			raise Exception("Unable to receive all the requested bytes (%d < %d)" % (len(data), length))
+
+		try:
+			return MK312._decode(data)
+		except Exception:
+			self.needHandshake = True
+			raise
+
+	async def peek(self, address):
+		return (await self.peekMany([address]))[0]
+
+	async def peekMany(self, addresses, window=8):
+		""" Reads several addresses, keeping up to 'window' requests in flight """
+		addresses = list(addresses)
+		values = []
+		async with self.lock:
+			retried = False
+			while len(values) < len(addresses):
+				if self.needHandshake:
+					await self._flushInputBuffer()
+					await self.handshake()
+
+				pending = addresses[len(values):len(values)+window]
+				for address in pending:
+					await self._write([0x3c, address >> 8, address & 0xff])
+
+				try:
+					for address in pending:
+						values.append((await self._read(3))[1])
+				except Exception as e:
+					if retried:
+						raise(e)
+					retried = True
+		return values
+
+	async def poke(self, startAddress, data):
+		async with self.lock:
+			if self.needHandshake:
+				await self.handshake()
+			await self._write(MK312._pokeCommand(startAddress, data))
+			return await self.link.recv(1)
+
+	async def close(self):
+		if self.encryptionEnabled and self.encryptionKey is not None:
+			await self.poke(0x4213, [0x0]) # reset key
+		await self.link.close()
+
+
+class AsyncNetworkLink():
+	def __init__(self, reader, writer, debug=False):
+		self.reader, self.writer = reader, writer
+		self.debug = debug
+
+	@classmethod
+	async def connect(cls, ip, port, timeout=0.5, debug=False):
+		reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+		writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return cls(reader, writer, debug)
+
+	async def send(self, data):
+		if self.debug: print("send", data.hex())
+		self.writer.write(data)
+		await self.writer.drain()
+
+	async def recv(self, length=1, timeout=0.5):
+		try:
+			data = await asyncio.wait_for(self.reader.read(length), timeout)
+		except asyncio.TimeoutError:
+			data = b""
+		if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
+		return data
+
+	async def close(self):
+		self.writer.close()
+		await self.writer.wait_closed()
+
+
+class AsyncSerialLink():
+	""" Non-blocking serial port, waiting for data with the event loop (or an executor if the loop can't watch it) """
+	def __init__(self, port, baudrate=19200, debug=False):
+		self.debug = debug
+		self.serial = serial.Serial(port, baudrate, timeout=0, parity=serial.PARITY_NONE, bytesize=8, stopbits=1, xonxoff=0, rtscts=0)
+		if fcntl is not None:
+			fcntl.flock(self.serial.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+	async def send(self, data):
+		if self.debug: print("send", data.hex())
+		self.serial.write(data)
+
+	async def recv(self, length=1, timeout=0.2):
+		data = self.serial.read(length)
+		if not data:
+			loop = asyncio.get_running_loop()
+			try:
+				readable = loop.create_future()
+				loop.add_reader(self.serial.fileno(), lambda: readable.done() or readable.set_result(None))
+				try:
+					await asyncio.wait_for(readable, timeout)
+				except asyncio.TimeoutError:
+					pass
+				finally:
+					loop.remove_reader(self.serial.fileno())
+				data = self.serial.read(length)
+			except (NotImplementedError, AttributeError):
+				# e.g. windows, the read is then done by a thread of the default executor
+				self.serial.timeout = timeout
+				data = await loop.run_in_executor(None, self.serial.read, length)
+				self.serial.timeout = 0
+		if self.debug: print("recv %s (%d/%d)" % (data.hex(), len(data), length))
+		return data
+
+	async def close(self):
+		self.serial.close()
+
+
+class AsyncBoxWorker():
+	""" Counterpart of BoxWorker for an event loop: a task writing the registers set with setValue() to a box through
+	AsyncMK312, so one loop can drive several boxes (and the UDPServer, see listenAsync()) without a thread for each.
+	It is only meant for remote controlling: nothing is polled besides what the controls need when connecting. """
+	registers = BoxWorker.registers
+	statusUpdated = Signal(int, str)
+	potsOverrideUpdated = Signal(bool)
+
+	def __init__(self):
+		self.portName = None
+		self.box = None
+		self.paramsValues = {}
+		self.linkStats = LinkStats()
+		self.lock = threading.Lock() # setValue() is called from other threads
+		self.registersToWrite = {}
+		self.writeRequestTimes = {}
+		self.writeLatencies = collections.deque(maxlen=256) # (name, seconds from setValue() to the end of the poke)
+		self.loop, self.wakeup = None, None
+		self.exitLoop = False
+
+	def open(self, portName):
+		self.portName = portName
+
+	def setValue(self, name, value):
+		with self.lock:
+			self.writeRequestTimes.setdefault(name, time.time())
+			self.registersToWrite[name] = value
+		self.notify()
+
+	def notify(self):
+		if self.loop is not None:
+			self.loop.call_soon_threadsafe(self.wakeup.set)
+
+	def applyLatency(self, names=None):
+		""" Same as BoxWorker.applyLatency() """
+		samples = sorted(t for name, t in list(self.writeLatencies) if names is None or name in names)
+		if not samples:
+			return 0
+		return max(0, samples[len(samples) // 2] - self.linkStats.recentMean('poke') / 2)
+
+	async def connect(self):
+		host, port, encrypted = parsePortName(self.portName)
+		if host is not None:
+			link = await AsyncNetworkLink.connect(host, port)
+		else:
+			link = AsyncSerialLink(self.portName)
+		start = time.time()
+		try:
+			self.box = await AsyncMK312.open(link, encrypted)
+		except Exception:
+			await link.close()
+			raise
+		self.linkStats.record('open', time.time() - start)
+		values = await self.box.peekMany((self.registers['multiadjust_min'], self.registers['multiadjust_max'], self.registers['adc_disable']['addr']))
+		self.paramsValues['multiadjust_min'], self.paramsValues['multiadjust_max'] = values[0], values[1]
+		self.paramsValues['adc_disable'] = bool(values[2] & (1 << self.registers['adc_disable']['bit']))
+		self.statusUpdated.emit(1, "Connected (asyncio)")
+		self.potsOverrideUpdated.emit(self.paramsValues['adc_disable'])
+
+	async def writeRegister(self, name, value):
+		register = self.registers[name]
+		if type(register) == dict:
+			if 'bit' in register:
+				current = await self.box.peek(register['addr'])
+				value = (current & ~(1 << register['bit'])) | (1 << register['bit'] if value else 0)
+			else:
+				value+= register['offset']
+			register = register['addr']
+		start = time.time()
+		ack = await self.box.poke(register, [value & 0xff])
+		self.linkStats.record('poke', time.time() - start)
+		if not ack or ack[0] != 0x06:
+			self.linkStats.count('poke_errors')
+
+	async def run(self):
+		""" Connects and writes until stop(), the last values are written before closing """
+		self.loop = asyncio.get_running_loop()
+		self.wakeup = asyncio.Event()
+		while not self.exitLoop:
+			writes = {}
+			try:
+				await self.connect()
+				with self.lock:
+					# the writes requested while connecting don't tell anything about the latency of the link
+					for name in self.writeRequestTimes:
+						self.writeRequestTimes[name] = time.time()
+				while True:
+					with self.lock:
+						writes, self.registersToWrite = self.registersToWrite, {}
+						requestTimes, self.writeRequestTimes = self.writeRequestTimes, {}
+					if not writes:
+						if self.exitLoop:
+							break
+						await self.wakeup.wait()
+						self.wakeup.clear()
+						continue
+					for name, value in list(writes.items()):
+						await self.writeRegister(name, value)
+						self.writeLatencies.append((name, time.time() - requestTimes.get(name, time.time())))
+						del writes[name]
+			except Exception as e:
+				self.linkStats.count('reconnects')
+				self.statusUpdated.emit(3, str(e))
+				with self.lock:
+					# the values not written yet, unless they were set again meanwhile
+					for name, value in writes.items():
+						self.registersToWrite.setdefault(name, value)
+				if self.box is not None:
+					try:
+						await self.box.link.close()
+					except Exception:
+						pass
+					self.box = None
+				await asyncio.sleep(1)
+
+		if self.box is not None:
+			try:
+				# reset the key and close the port
+				await self.box.close()
+			except Exception as e:
+				print(str(e))
+			self.box = None
+		self.loop = None
+		self.statusUpdated.emit(1, "Port closed.")
+
+	def stop(self):
+		self.exitLoop = True
+		self.notify()
+
+	close = stop # the task closes the port before it ends
+
+
+async def discoverAsync(timeout=0.5):
+	""" Broadcasts the MK312 Wi-Fi bridge discovery message, returns {host: reply latency in seconds} """
+	UDP_DISCOVERY_PORT = 8842
+	loop = asyncio.get_running_loop()
+	hosts = {}
+
+	class DiscoveryProtocol(asyncio.DatagramProtocol):
+		def connection_made(self, transport):
+			self.start = loop.time()
+			transport.sendto(b"ICQ-MK312", ('255.255.255.255', UDP_DISCOVERY_PORT))
+
+		def datagram_received(self, data, addr):
+			if addr[1] == UDP_DISCOVERY_PORT:
+				hosts[addr[0]] = loop.time() - self.start
+
+	transport, protocol = await loop.create_datagram_endpoint(DiscoveryProtocol, family=socket.AF_INET, allow_broadcast=True)
+	try:
+		await asyncio.sleep(timeout)
+	finally:
+		transport.close()
+	return hosts
+
+
+class DiscoveryService():
+	""" Looks for MK312 Wi-Fi bridges in its own thread, and remembers the ones which answered """
+	hostDiscovered = Signal(str)
+
+	def __init__(self, interval=2.0, timeout=0.5):
+		self.interval = interval
+		self.timeout = timeout
+		self.paused = False
+		self.lock = threading.Lock()
+		self.hosts = {} # {host: (last seen time, reply latency in seconds)}
+		self.thread = None
+
+	def start(self):
+		self.exitLoop = False
+		self.thread = threading.Thread(target=self.run, name="Discovery thread", daemon=True)
+		self.thread.start()
+
+	def run(self):
+		asyncio.run(self.serve())
+
+	async def serve(self):
+		nextTime = 0
+		while not self.exitLoop:
+			if self.paused or time.time() < nextTime:
+				await asyncio.sleep(0.1)
+				continue
+			nextTime = time.time() + self.interval
+			try:
+				hosts = await discoverAsync(self.timeout)
+			# "Network is unreachable" can happen when waking up from sleep
+			except OSError as e:
+				print(str(e))
+				continue
+			now = time.time()
+			for host, latency in hosts.items():
+				with self.lock:
+					new = host not in self.hosts
+					self.hosts[host] = (now, latency)
+				if new:
+					print("Discovered %s (%.2fms)" % (host, 1000 * latency))
+					self.hostDiscovered.emit(host)
+
+	def cachedHosts(self):
+		""" Returns [(host, last seen time, latency)], the most recently seen first """
+		with self.lock:
+			return sorted(((host, lastSeen, latency) for host, (lastSeen, latency) in self.hosts.items()), key=lambda h: -h[1])
+
+	def setPaused(self, paused):
+		self.paused = paused
+
+	def stop(self):
+		self.exitLoop = True
+
+
+class BoxController():
+	""" Several boxes driven at the same time. Each one has its own BoxWorker, so its own thread and link:
+	a slow link or a box not answering never delays the others. """
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.workers = {}  # {name: BoxWorker}
+		self.gains = {}    # {name: factor applied to the levels sent to this box}
+		self.groups = collections.defaultdict(set) # {group name: box names}
+		self.remoteGroup = 'remote' # the boxes following the remote controlled levels
+
+	levelRegisters = ('channel_a_level', 'channel_b_level') # the registers the gains apply to
+
+	def addBox(self, name, worker=None, gain=1.0, groups=(), overridePots=False):
+		""" Adds a box, overridePots takes the control of its levels (from its knobs) on each connection """
+		if worker is None:
+			worker = BoxWorker()
+		if overridePots:
+			worker.potsOverrideUpdated.connect(lambda state: state or worker.setValue('adc_disable', True))
+		with self.lock:
+			if name in self.workers:
+				raise Exception("There is already a box named %s" % (name))
+			self.workers[name] = worker
+			self.gains[name] = gain
+			for group in groups:
+				self.groups[group].add(name)
+		return worker
+
+	def removeBox(self, name):
+		with self.lock:
+			worker = self.workers.pop(name)
+			del self.gains[name]
+			for names in self.groups.values():
+				names.discard(name)
+		worker.stop()
+
+	def setGain(self, name, gain):
+		self.gains[name] = gain
+
+	def boxes(self, group=None):
+		""" Returns [(name, worker)] of a group, or of all the boxes """
+		with self.lock:
+			names = self.workers.keys() if group is None else self.groups.get(group, ())
+			return [(name, self.workers[name]) for name in sorted(names)]
+
+	def setValue(self, group, name, value):
+		""" Writes a register on all the boxes of a group, scaled by their gain for the channel levels """
+		for boxName, worker in self.boxes(group):
+			if name in self.levelRegisters:
+				worker.setValue(name, min(255, max(0, int(round(value * self.gains.get(boxName, 1.0))))))
+			else:
+				worker.setValue(name, value)
+
+	def setMultiAdjust(self, group, position):
+		""" Sets the multi-adjust of all the boxes of a group, from the position of the knob (0 to 1, in their current range) """
+		for boxName, worker in self.boxes(group):
+			valMin, valMax = worker.paramsValues.get('multiadjust_min'), worker.paramsValues.get('multiadjust_max')
+			if valMin is not None and valMax is not None:
+				worker.setValue('multiadjust_scaled', valMax - int(round(min(1, max(0, position)) * (valMax - valMin))))
+
+	def close(self):
+		for name, worker in self.boxes():
+			worker.close()
+
+	def stop(self):
+		for name, worker in self.boxes():
+			worker.stop()
+
+	def formatStats(self):
+		return '\n\n'.join("[%s] %s\n%s" % (name, worker.portName or "closed", worker.linkStats.format()) for name, worker in self.boxes())
+
+
+class RemoteControl():
+	""" Applies the remote control values to the levels of the boxes of a group, directly from the thread receiving
+	them, so their latency doesn't depend on the GUI (it only displays the last levels, see snapshot()).
+	The values received faster than a link can write them are merged by its worker: the last one wins.
+
+	The timestamped (v2) messages go through a jitter buffer: each one is applied bufferDelay after the time it was
+	sent, minus the time the slowest box of the group takes to receive a level (BoxWorker.applyLatency()),
+	so the timing errors of the sender and of the network are removed, at the cost of this constant delay.
+	A clock message telling the media player is paused (speed 0) stops the channels at once, with the queue. """
+	channels = ('channel_a_level', 'channel_b_level')
+	maxClockSkew = 0.5 # seconds, further in the future than that, the clock of the sender is not the same as ours
+
+	def __init__(self, controller, group, bufferDelay=0.1):
+		self.controller = controller
+		self.group = group
+		self.bufferDelay = bufferDelay # seconds, 0 to apply the messages as soon as they are received
+		self.lock = threading.Lock()
+		self.factors = dict.fromkeys(self.channels, 0.0)
+		self.settings = dict.fromkeys(self.channels) # {channel: (level for a factor of 1, offset) if remote controlled, else None}
+		self.levels = {}         # {channel: last level written}
+		self.multiAdjust = None  # last knob position received
+		self.generation = 0      # incremented on each change, for the displays
+
+		self.stats = LinkStats()
+		self.queue = [] # heap of (time to apply, sequence, RemoteMessage)
+		self.queueCondition = threading.Condition()
+		self.queueCounter = 0
+		self.lead = 0  # last compensation of the write latency (s)
+		self.skew = 0  # moving average of the time the messages were applied after their due time (s)
+		self.exitLoop = False
+		self.thread = threading.Thread(target=self.run, name="RemoteControl thread", daemon=True)
+		self.thread.start()
+
+	def connect(self, udpServer):
+		udpServer.receivedPacket.connect(self.handleLegacyMessage)
+		udpServer.receivedMessage.connect(self.handleMessage)
+		udpServer.receivedClock.connect(self.handleClock)
+
+	def setChannel(self, name, level=None, offset=0):
+		""" Remote controls a channel: its level for a factor of 1 and an offset, or None to stop """
+		with self.lock:
+			self.settings[name] = None if level is None else (level, offset)
+			self.apply(name)
+
+	def apply(self, name):
+		# called with the lock held
+		setting = self.settings[name]
+		if setting is not None:
+			level, offset = setting
+			self.levels[name] = min(255, max(0, int(round(level * self.factors[name] + offset))))
+			self.controller.setValue(self.group, name, self.levels[name])
+			self.generation+= 1
+
+	def setFactors(self, factors):
+		""" Factors between 0 and 2, {channel: factor} """
+		with self.lock:
+			for name, factor in factors.items():
+				self.factors[name] = min(2, max(0, float(factor)))
+				self.apply(name)
+
+	def setMultiAdjust(self, position):
+		""" Follows the multi-adjust knob position (0 to 1) when a channel is remote controlled """
+		with self.lock:
+			self.multiAdjust = min(1, max(0, position))
+			if any(setting is not None for setting in self.settings.values()):
+				self.controller.setMultiAdjust(self.group, self.multiAdjust)
+				self.generation+= 1
+
+	def handleLegacyMessage(self, msg):
+		try:
+			factor = float(msg) if msg != '' else 0
+		except ValueError as e:
+			print(str(e))
+			factor = 0 # stop rather than keep the previous levels
+		self.setFactors(dict.fromkeys(self.channels, factor))
+
+	def handleMessage(self, message):
+		if not self.bufferDelay:
+			self.applyMessage(message)
+			return
+
+		self.lead = self.applyLatency()
+		dueTime = message.timestamp + self.bufferDelay - self.lead
+		now = time.time()
+		if dueTime > now + self.bufferDelay + self.maxClockSkew:
+			self.stats.count('clock_mismatch')
+			self.applyMessage(message)
+		elif dueTime <= now:
+			self.stats.count('late')
+			self.applyMessage(message, dueTime)
+		else:
+			with self.queueCondition:
+				self.queueCounter+= 1
+				heapq.heappush(self.queue, (dueTime, self.queueCounter, message))
+				self.queueCondition.notify()
+
+	def handleClock(self, message):
+		if message.speed == 0:
+			self.pause()
+
+	def pause(self):
+		""" Stops the channels without waiting for the jitter buffer, the messages still queued are dropped """
+		self.stats.count('pauses')
+		with self.queueCondition:
+			self.queue = []
+		self.setFactors(dict.fromkeys(self.channels, 0))
+
+	def applyLatency(self):
+		""" Time the slowest box of the group takes to receive a level (seconds) """
+		return max([worker.applyLatency(self.channels) for name, worker in self.controller.boxes(self.group)] or [0])
+
+	def applyMessage(self, message, dueTime=None):
+		if dueTime is not None:
+			skew = time.time() - dueTime
+			self.stats.record('skew', skew)
+			self.skew = 0.9 * self.skew + 0.1 * skew
+		self.setFactors({name: factor for name, factor in zip(self.channels, (message.a, message.b)) if factor is not None})
+		if message.multiAdjust is not None:
+			self.setMultiAdjust(message.multiAdjust)
+
+	def run(self):
+		while not self.exitLoop:
+			with self.queueCondition:
+				while not self.exitLoop and (not self.queue or self.queue[0][0] > time.time()):
+					self.queueCondition.wait(self.queue[0][0] - time.time() if self.queue else None)
+				if self.exitLoop:
+					break
+				dueTime, counter, message = heapq.heappop(self.queue)
+			self.applyMessage(message, dueTime)
+
+	def status(self):
+		""" State of the jitter buffer, for the displays """
+		with self.queueCondition:
+			queued = len(self.queue)
+		snapshot = self.stats.snapshot()
+		return {'buffer_delay': self.bufferDelay, 'queued': queued, 'lead': self.lead, 'skew': self.skew,
+		        'applied': snapshot['operations'].get('skew', {}).get('count', 0), 'late': snapshot['counters'].get('late', 0)}
+
+	def stop(self):
+		with self.queueCondition:
+			self.exitLoop = True
+			self.queueCondition.notify()
+
+	def snapshot(self):
+		""" Returns (generation, {channel: last level written}, last multi-adjust position) """
+		with self.lock:
+			return self.generation, dict(self.levels), self.multiAdjust
+
+
+# remote control message (v2), the values are None when they don't change
+RemoteMessage = collections.namedtuple('RemoteMessage', 'seq timestamp a b multiAdjust')
+# position of a media player (seconds) at the time the message was sent, its speed is 0 while paused
+ClockMessage = collections.namedtuple('ClockMessage', 'seq timestamp position speed')
+
+
+class UDPServer():
+	""" Receives the remote control messages.
+
+	The legacy format is one factor per line (ASCII float, applied to both channels, empty line for 0).
+	The v2 format carries a sequence number, the time it was sent (Unix time) and independent values:
+	the A and B factors (0 to 2) and the multi-adjust knob position (0 to 1), each one being optional.
+	It is binary (binaryFormat, NaN for the unchanged values) or text for the senders not able to pack
+	binary data (Lua 5.1): "MKR2 <seq> <timestamp> <A> <B> <multi-adjust>", with "-" for the unchanged values.
+	Media players can also send their position, for the playback of funscripts (see UDPClock):
+	"MKRT <seq> <timestamp> <position> <speed>", with a speed of 0 while paused.
+	The v2 messages older than the last one received from the same sender, or older than maxAge
+	(only if the clocks of the sender and of this host are synchronised, it is off by default), are dropped. """
+	receivedPacket = Signal(str)
+	receivedMessage = Signal(object)
+	receivedClock = Signal(object)
+
+	binaryFormat = struct.Struct('<4sIdfff')
+	magic = b'MKR\x02'  # binary messages, the text ones start with "MKR2 "
+	textPattern = re.compile(r'^MKR2 (\d{1,10}) (\d+(?:\.\d+)?)' + r' (-|\d+(?:\.\d+)?)' * 3 + '$')
+	clockPattern = re.compile(r'^MKRT (\d{1,10})' + r' (\d+(?:\.\d+)?)' * 3 + '$')
+
+	maxSenders = 64 # the sequence numbers of the senders heard the least recently are forgotten
+
+	def __init__(self, port=50000, maxAge=0, thread=True):
+		self.port = port
+		self.maxAge = maxAge # seconds, 0 to never drop the late messages
+		self.stats = LinkStats()
+		self.lastSeqs = collections.OrderedDict() # {(sender address, message type): last sequence number applied}
+		self.receive_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+		self.receive_socket.bind(('', self.port))
+		self.exitLoop = False
+		if thread:
+			self.serverThread = threading.Thread(target=self.run, name="UDP Server Thread", daemon=True)
+			self.serverThread.start()
+
+	@classmethod
+	def encode(cls, seq, a=None, b=None, multiAdjust=None, timestamp=None, text=False):
+		""" Builds a v2 message (for the senders written in Python) """
+		if timestamp is None:
+			timestamp = time.time()
+		values = (a, b, multiAdjust)
+		if text:
+			return ("MKR2 %d %.4f %s\n" % (seq & 0xffffffff, timestamp, ' '.join('-' if v is None else '%.4f' % (v) for v in values))).encode('ascii')
+		return cls.binaryFormat.pack(cls.magic, seq & 0xffffffff, timestamp, *(float('nan') if v is None else v for v in values))
+
+	@classmethod
+	def decode(cls, data):
+		""" Returns the RemoteMessages (or ClockMessages) of a packet, [] if it isn't in the v2 format, raises an Exception if it is invalid """
+		if data.startswith(b'MKRT '):
+			messages = []
+			for line in data.decode('ascii').strip().split("\n"):
+				m = cls.clockPattern.match(line)
+				if not m:
+					raise Exception("Invalid clock message: %s" % (line[:64]))
+				messages.append(ClockMessage(int(m.group(1)) & 0xffffffff, *(float(v) for v in m.group(2, 3, 4))))
+			return messages
+		if data.startswith(b'MKR2 '):
+			messages = []
+			for line in data.decode('ascii').strip().split("\n"):
+				m = cls.textPattern.match(line)
+				if not m:
+					raise Exception("Invalid remote control message: %s" % (line[:64]))
+				values = [None if v == '-' else float(v) for v in m.group(3, 4, 5)]
+				messages.append(RemoteMessage(int(m.group(1)) & 0xffffffff, float(m.group(2)), *values))
+			return messages
+		if data.startswith(cls.magic):
+			if len(data) != cls.binaryFormat.size:
+				raise Exception("Invalid remote control message length: %d" % (len(data)))
+			magic, seq, timestamp, *values = cls.binaryFormat.unpack(data)
+			return [RemoteMessage(seq, timestamp, *(None if v != v else v for v in values))]
+		return []
+
+	def accept(self, sender, message, now):
+		""" Updates the statistics, returns False if the message is out of order or expired """
+		latency = now - message.timestamp
+		self.stats.count('received')
+		self.stats.record('latency', max(0, latency))
+		sender = (sender, type(message)) # the clock messages have their own sequence numbers
+		lastSeq = self.lastSeqs.get(sender)
+		if lastSeq is not None:
+			delta = (message.seq - lastSeq) & 0xffffffff
+			if delta == 0 or delta & 0x80000000:
+				self.stats.count('dropped_reordered')
+				return False
+			if delta > 1:
+				self.stats.count('lost', delta - 1)
+		self.lastSeqs[sender] = message.seq
+		self.lastSeqs.move_to_end(sender)
+		if len(self.lastSeqs) > self.maxSenders:
+			self.lastSeqs.popitem(last=False)
+		if self.maxAge and latency > self.maxAge:
+			self.stats.count('dropped_expired')
+			return False
+		return True
+
+	def run(self):
+		while not self.exitLoop:
+			msg, addr = self.receive_socket.recvfrom(4096)
+			self.handleDatagram(msg, addr)
+
+	async def listenAsync(self):
+		""" Receives the messages from the running event loop, instead of the thread (created with thread=False).
+		Returns the transport, to close once done. """
+		server = self
+		class RemoteControlProtocol(asyncio.DatagramProtocol):
+			def datagram_received(self, data, addr):
+				server.handleDatagram(data, addr)
+
+		transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(RemoteControlProtocol, sock=self.receive_socket)
+		return transport
+
+	def handleDatagram(self, msg, addr):
+		now = time.time()
+		try:
+			messages = self.decode(msg)
+			for message in messages:
+				if self.accept(addr, message, now):
+					if type(message) == ClockMessage:
+						self.receivedClock.emit(message)
+					else:
+						self.receivedMessage.emit(message)
+			if messages:
+				return
+
+			self.stats.count('received_legacy')
+			for content in msg.decode('ascii').strip().split("\n"):
+				self.receivedPacket.emit(content)
+
+		except Exception as e:
+			self.stats.count('invalid')
+			print('UDP ERROR: '+str(e))
+
+	def stop(self):
+		self.exitLoop = True
+
+
+class Funscript():
+	""" Actions of a funscript ({"range": 100, "actions": [{"at": ms, "pos": 0 to range}]}) as a timeline of factors
+	(0 to 1) linearly interpolated between them, found with a binary search like in FunscriptTimeline """
+	def __init__(self, path):
+		with open(path, 'r') as f:
+			data = json.load(f)
+		maxi = data.get('range') or 100
+		# stable sort by time only, like funscript2srt.py: among actions at the same time, the last one in the file wins
+		actions = sorted(((action['at'] / 1000, min(1, max(0, action['pos'] / maxi))) for action in data['actions']), key=lambda a: a[0])
+		if not actions:
+			raise Exception("No actions in %s" % (path))
+
+		self.path = path
+		self.times = [t for t, v in actions]
+		self.values = [v for t, v in actions]
+		self.start, self.end = self.times[0], self.times[-1]
+
+	def value(self, position):
+		""" Factor at this position of the media (seconds) """
+		i = bisect.bisect_right(self.times, position) - 1
+		if i < 0:
+			return self.values[0]
+		if i >= len(self.times) - 1:
+			return self.values[-1]
+		t0, t1, v0, v1 = self.times[i], self.times[i+1], self.values[i], self.values[i+1]
+		return v0 + (position - t0) * (v1 - v0) / (t1 - t0)
+
+
+class FunscriptTimeline():
+	""" Funscript compiled by "utils/funscript2srt.py --binary": records of (time, factor) sorted by time, and a seek index
+	with the time of every indexStep-th record. The file is memory-mapped, so it opens instantly whatever its size,
+	and a position is found with a binary search in the index and then in one block of records. """
+	magic = b'MK312TL\x01'
+	headerFormat = struct.Struct('<8sIIII') # magic, record count, records per index entry, index entries, offset of the records
+	recordFormat = struct.Struct('<If')     # time (ms), factor (0 to 1)
+
+	def __init__(self, path):
+		if sys.byteorder != 'little':
+			raise Exception("The timelines can only be read on little-endian hosts")
+		self.path = path
+		with open(path, 'rb') as f:
+			self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.count, self.indexStep, indexCount, self.recordsOffset = self.headerFormat.unpack_from(self.mmap)
+		if magic != self.magic or not self.count or self.recordsOffset + self.count * self.recordFormat.size > len(self.mmap):
+			raise Exception("Not a valid timeline: %s" % (path))
+		view = memoryview(self.mmap)
+		self.index = view[self.headerFormat.size:self.headerFormat.size + 4 * indexCount].cast('I')
+		self.times = view[self.recordsOffset:self.recordsOffset + self.count * self.recordFormat.size].cast('I')[0::2]
+		self.start = self.times[0] / 1000
+		self.end = self.times[-1] / 1000
+
+	def find(self, ms):
+		""" Index of the last record at or before this time, -1 if there is none """
+		block = bisect.bisect_right(self.index, ms) - 1
+		if block < 0:
+			return -1
+		start = block * self.indexStep
+		return bisect.bisect_right(self.times, ms, start, min(self.count, start + self.indexStep)) - 1
+
+	def record(self, i):
+		""" Returns (time in seconds, factor) """
+		ms, value = self.recordFormat.unpack_from(self.mmap, self.recordsOffset + i * self.recordFormat.size)
+		return ms / 1000, value
+
+	def value(self, position):
+		""" Factor at this position of the media (seconds), linearly interpolated """
+		i = self.find(int(position * 1000))
+		if i < 0:
+			return self.record(0)[1]
+		if i >= self.count - 1:
+			return self.record(self.count - 1)[1]
+		(t0, v0), (t1, v1) = self.record(i), self.record(i + 1)
+		return v0 + (position - t0) * (v1 - v0) / (t1 - t0)
+
+	def close(self):
+		self.index.release()
+		self.times.release()
+		self.mmap.close()
+
+
+def loadFunscript(path):
+	""" Returns a FunscriptTimeline, or a Funscript if the file isn't a compiled timeline """
+	with open(path, 'rb') as f:
+		magic = f.read(len(FunscriptTimeline.magic))
+	if magic == FunscriptTimeline.magic:
+		return FunscriptTimeline(path)
+	return Funscript(path)
+
+
+class MediaClock():
+	""" Position of a media player, extrapolated from the last one it gave """
+	staleAfter = 5.0 # seconds without news before the position is unknown
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reference = None # (time, position, speed)
+
+	def update(self, t, position, speed):
+		with self.lock:
+			self.reference = (t, position, speed)
+
+	def setSpeed(self, speed):
+		with self.lock:
+			if self.reference is not None:
+				t, position, oldSpeed = self.reference
+				now = time.time()
+				self.reference = (now, position + (now - t) * oldSpeed, speed)
+
+	def clear(self):
+		with self.lock:
+			self.reference = None
+
+	def position(self, now=None):
+		""" Returns (position at this time, playing), or (None, False) if it is unknown """
+		if now is None:
+			now = time.time()
+		with self.lock:
+			reference = self.reference
+		if reference is None or now - reference[0] > self.staleAfter:
+			return None, False
+		t, position, speed = reference
+		return position + (now - t) * speed, speed > 0
+
+
+class UDPClock(MediaClock):
+	""" Position sent by a media player to the UDPServer (ClockMessages), its clock has to be synchronised with ours """
+	def connect(self, udpServer):
+		udpServer.receivedClock.connect(lambda message: self.update(message.timestamp, message.position, message.speed))
+
+
+class MpvClock(MediaClock):
+	""" Position of mpv, asked through its JSON IPC socket (mpv --input-ipc-server=PATH, not on Windows) """
+	queryInterval = 0.25
+	supported = hasattr(socket, 'AF_UNIX') # mpv uses a named pipe on Windows, subsync.lua sends the position there
+
+	def __init__(self, path):
+		if not self.supported:
+			raise Exception("Following mpv through its IPC socket is not supported on this system")
+		MediaClock.__init__(self)
+		self.path = path
+		self.exitLoop = False
+		self.thread = threading.Thread(target=self.run, name="mpv clock thread", daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while not self.exitLoop:
+			try:
+				self.follow()
+			except Exception as e:
+				# never let the thread die, mpv may be started (again) later
+				self.clear()
+				print("mpv IPC: %s" % (e))
+				time.sleep(1)
+
+	def follow(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.settimeout(self.queryInterval)
+			sock.connect(self.path)
+			print("mpv IPC: connected to %s" % (self.path))
+			sock.sendall(b'{"command": ["observe_property", 1, "pause"]}\n{"command": ["observe_property", 2, "speed"]}\n')
+			paused, speed = True, 1.0
+			data = b''
+			requestId, requestTime, nextQuery = 0, 0, 0
+			while not self.exitLoop:
+				now = time.time()
+				if now >= nextQuery:
+					requestId+= 1
+					requestTime, nextQuery = now, now + self.queryInterval
+					sock.sendall(json.dumps({'command': ['get_property', 'playback-time'], 'request_id': requestId}).encode() + b'\n')
+				try:
+					received = sock.recv(4096)
+				except socket.timeout:
+					continue
+				if not received:
+					raise OSError("connection closed by mpv")
+				*lines, data = (data + received).split(b'\n')
+				for line in lines:
+					message = json.loads(line)
+					event = message.get('event')
+					if event == 'property-change':
+						if message['name'] == 'pause':
+							paused = message.get('data', True)
+						elif message['name'] == 'speed':
+							speed = message.get('data') or 1.0
+						self.setSpeed(0 if paused else speed)
+						nextQuery = 0
+					elif event in ('seek', 'playback-restart'):
+						nextQuery = 0
+					elif event in ('end-file', 'idle'):
+						self.clear()
+					elif event is None and message.get('request_id') == requestId:
+						if message.get('error') == 'success' and message.get('data') is not None:
+							# the middle of the request is the best guess of when it was answered
+							self.update((requestTime + time.time()) / 2, message['data'], 0 if paused else speed)
+						else:
+							self.clear()
+		finally:
+			sock.close()
+
+	def stop(self):
+		self.exitLoop = True
+
+
+class FunscriptPlayer():
+	""" Plays funscripts ({channel: Funscript}) into a RemoteControl, at the position of a MediaClock.
+	The values are taken ahead by the time the boxes take to receive them, and sent as often as the slowest box
+	of the group can write them while leaving the same time to the polling. They are 0 while the media is paused. """
+	minInterval = 0.01
+	maxInterval = 0.1
+
+	def __init__(self, remoteControl, clock, scripts):
+		self.remoteControl = remoteControl
+		self.clock = clock
+		self.scripts = scripts
+		self.updates = 0
+		self.exitLoop = False
+		self.thread = threading.Thread(target=self.run, name="Funscript player thread", daemon=True)
+		self.thread.start()
+
+	def updateInterval(self):
+		workers = self.remoteControl.controller.boxes(self.remoteControl.group)
+		pokeTime = max([worker.linkStats.recentMean('poke') for name, worker in workers] or [0])
+		return min(self.maxInterval, max(self.minInterval, 2 * pokeTime))
+
+	def run(self):
+		lastFactors = None
+		while not self.exitLoop:
+			position, playing = self.clock.position(time.time() + self.remoteControl.applyLatency())
+			if playing:
+				# rounded, so the levels are not written again for changes too small to matter
+				factors = {channel: round(script.value(position), 3) for channel, script in self.scripts.items()}
+			else:
+				factors = dict.fromkeys(self.scripts, 0)
+			if factors != lastFactors:
+				self.remoteControl.setFactors(factors)
+				lastFactors = factors
+				self.updates+= 1
+			time.sleep(self.updateInterval())
+
+	def stop(self):
+		self.exitLoop = True
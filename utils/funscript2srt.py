@@ -1,55 +1,256 @@
 #!/usr/bin/env python3
 # Funscript2SRT by @cLxJaguar (2023)
 
-import os, sys, argparse, json
+import os, argparse, json, struct, array
 
-def convert(filename, actionTimeout=2):
-	filenameOut = os.path.splitext(filename)[0] + '.srt'
-	f = open(filename, 'r')
-	print("Converting \"%s\" to \"%s\"..." % (filename, filenameOut))
-	data = json.load(f)
-	for d in data:
-		content = data[d]
-		if type(content) == list:
+try:
+	import numpy
+except ImportError:
+	numpy = None # same results without it, only slower
+
+# binary timeline (read by FunscriptTimeline in mk312core.py), little-endian:
+# header, seek index (time of every indexStep-th record, uint32 ms), padding to 8 bytes, records sorted by time
+TIMELINE_MAGIC = b'MK312TL\x01'
+TIMELINE_HEADER = struct.Struct('<8sIIII') # magic, record count, records per index entry, index entries, offset of the records
+TIMELINE_RECORD = struct.Struct('<If')     # time (ms), factor (0 to 1)
+
+class JsonStream():
+	""" Reads the JSON values of a file one after the other, with only a chunk of it in memory """
+	def __init__(self, f, chunkSize=1 << 16):
+		self.f = f
+		self.chunkSize = chunkSize
+		self.buf, self.pos = '', 0
+		self.decoder = json.JSONDecoder()
+
+	def fill(self):
+		data = self.f.read(self.chunkSize)
+		self.buf, self.pos = self.buf[self.pos:] + data, 0
+		return data != ''
+
+	def peek(self):
+		""" Next non-blank character, '' at the end of the file """
+		while True:
+			while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+				self.pos+= 1
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+			if not self.fill():
+				return ''
+
+	def expect(self, chars):
+		c = self.peek()
+		if c == '' or c not in chars:
+			raise Exception("Invalid JSON: %r instead of %s" % (c, ' or '.join(repr(c) for c in chars)))
+		self.pos+= 1
+		return c
+
+	def value(self):
+		self.peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buf, self.pos)
+				# a number can be cut at the end of the buffer
+				if end < len(self.buf) or not self.fill():
+					self.pos = end
+					return value
+			except json.JSONDecodeError:
+				if not self.fill():
+					raise
+
+def streamFunscript(f):
+	""" Yields (key, value) for the top-level keys of a funscript, but ('action', action) for each action """
+	s = JsonStream(f)
+	s.expect('{')
+	if s.peek() == '}':
+		return
+	while True:
+		key = s.value()
+		s.expect(':')
+		if key == 'actions':
+			s.expect('[')
+			if s.peek() == ']':
+				s.expect(']')
+			else:
+				while True:
+					yield 'action', s.value()
+					if s.expect(',]') == ']':
+						break
+		else:
+			yield key, s.value()
+		if s.expect(',}') == '}':
+			break
+
+def loadActions(filename, streaming=False):
+	""" Returns (other keys, times in ms, positions from 0 to 1, clamped) sorted by time, as numpy arrays if numpy is there.
+	In streaming mode, the file is never loaded whole and the actions are stored in compact arrays. """
+	with open(filename, 'r') as f:
+		if streaming:
+			infos = {}
+			times, positions = array.array('d'), array.array('d')
+			for key, value in streamFunscript(f):
+				if key == 'action':
+					times.append(value['at'])
+					positions.append(value['pos'])
+				else:
+					infos[key] = value
+			if numpy:
+				times, positions = numpy.frombuffer(times, dtype=numpy.float64), numpy.frombuffer(positions, dtype=numpy.float64)
+		else:
+			infos = json.load(f)
+			actions = infos.pop('actions')
+			if numpy:
+				times = numpy.fromiter((action['at'] for action in actions), dtype=numpy.float64, count=len(actions))
+				positions = numpy.fromiter((action['pos'] for action in actions), dtype=numpy.float64, count=len(actions))
+			else:
+				times, positions = [action['at'] for action in actions], [action['pos'] for action in actions]
+			del actions
+
+	if not len(times):
+		raise Exception("no actions")
+	maxi = infos.get('range') or 100
+	# the positions out of 0 to range are clamped
+	if numpy:
+		clamped = int(numpy.count_nonzero((positions < 0) | (positions > maxi)))
+	else:
+		clamped = sum(1 for p in positions if p < 0 or p > maxi)
+	if clamped:
+		print("Warning: %d positions out of 0 to %g, clamped" % (clamped, maxi))
+	if numpy:
+		order = numpy.argsort(times, kind='stable')
+		return infos, times[order], numpy.clip(positions[order] / maxi, 0, 1)
+	order = sorted(range(len(times)), key=times.__getitem__)
+	return infos, [times[i] for i in order], [min(1, max(0, positions[i] / maxi)) for i in order]
+
+def simplify(times, positions, epsilon, blockSize=1024):
+	""" Ramer-Douglas-Peucker: only keeps the actions the linear interpolation of the others misses by more than
+	epsilon (the distance is measured on the position, as the time is the playback's) """
+	n = len(times)
+	keep = [False] * n
+	keep[0] = True
+	# done by blocks (their ends are kept): on noisy curves, the farthest action is often near an end
+	# of its segment, which would make the time quadratic
+	segments = [(start, min(start + blockSize, n - 1)) for start in range(0, n - 1, blockSize)]
+	for first, last in segments:
+		keep[last] = True
+	timesList, positionsList = (times.tolist(), positions.tolist()) if numpy else (times, positions)
+	while segments:
+		first, last = segments.pop()
+		if last - first < 2:
 			continue
-		print('%s: %s' % (d, content))
+		t0, p0, t1, p1 = timesList[first], positionsList[first], timesList[last], positionsList[last]
+		slope = (p1 - p0) / (t1 - t0) if t1 != t0 else 0
+		# among equal errors (common with integer positions), the middle one keeps the segments balanced
+		if numpy and last - first > 64:
+			errors = numpy.abs(positions[first+1:last] - (p0 + (times[first+1:last] - t0) * slope))
+			error = errors.max()
+			candidates = numpy.flatnonzero(errors == error)
+		else:
+			errors = [abs(positionsList[k] - (p0 + (timesList[k] - t0) * slope)) for k in range(first + 1, last)]
+			error = max(errors)
+			candidates = [k for k, e in enumerate(errors) if e == error]
+		if error > epsilon:
+			k = first + 1 + int(candidates[len(candidates) // 2])
+			keep[k] = True
+			segments.append((first, k))
+			segments.append((k, last))
 
-	try:
-		maxi = data['range']
-	except:
-		maxi = 100
+	if numpy:
+		keep = numpy.array(keep)
+		return times[keep], positions[keep]
+	return [t for t, k in zip(times, keep) if k], [p for p, k in zip(positions, keep) if k]
 
-	f_out = open(filenameOut, 'w')
+def limitRate(times, positions, maxRate):
+	""" Drops the actions less than 1/maxRate after the previous one kept (the last action is always kept) """
+	minInterval = 1000 / maxRate
+	kept, last = [], None
+	for i, t in enumerate(times.tolist() if numpy else times):
+		if last is None or t - last >= minInterval:
+			kept.append(i)
+			last = t
+	if kept[-1] != len(times) - 1:
+		kept[-1] = len(times) - 1
+	if numpy:
+		return times[kept], positions[kept]
+	return [times[i] for i in kept], [positions[i] for i in kept]
 
-	def mkSrtTimeStamp(ms):
-		s = ms / 1000; ms%=1000
-		m = s / 60; s%=60
-		h = m / 60; m%=60
-		return "%02d:%02d:%02d,%03d" % (h, m, s, ms)
+def prepare(filename, epsilon=0, maxRate=0, streaming=False):
+	infos, times, positions = loadActions(filename, streaming)
+	for key, content in infos.items():
+		if type(content) != list:
+			print('%s: %s' % (key, content))
+	count = len(times)
+	if epsilon:
+		times, positions = simplify(times, positions, epsilon)
+	if maxRate:
+		times, positions = limitRate(times, positions, maxRate)
+	if len(times) != count:
+		print("%d actions, %d kept" % (count, len(times)))
+	return times, positions
 
-	i = 1
-	for action in data['actions']:
-		try:
-			nextAction = data['actions'][i]
-		except:
-			pass
+def convert(filename, actionTimeout=2, epsilon=0, maxRate=0, streaming=False):
+	filenameOut = os.path.splitext(filename)[0] + '.srt'
+	print("Converting \"%s\" to \"%s\"..." % (filename, filenameOut))
+	times, positions = prepare(filename, epsilon, maxRate, streaming)
+
+	# each subtitle ends after actionTimeout, or 10 ms before the next one
+	if numpy:
+		starts = numpy.rint(times).astype(numpy.int64)
+		ends = starts + int(actionTimeout * 1000)
+		ends[:-1] = numpy.maximum(starts[:-1], numpy.minimum(ends[:-1], starts[1:] - 10))
+		def splitTimeStamps(ms):
+			return zip((ms // 3600000).tolist(), (ms // 60000 % 60).tolist(), (ms // 1000 % 60).tolist(), (ms % 1000).tolist())
+		lines = zip(splitTimeStamps(starts), splitTimeStamps(ends), positions.tolist())
+	else:
+		starts = [int(round(t)) for t in times]
+		ends = [max(start, min(start + int(actionTimeout * 1000), nextStart - 10)) for start, nextStart in zip(starts, starts[1:])]
+		ends.append(starts[-1] + int(actionTimeout * 1000))
+		def splitTimeStamps(ms):
+			return [(t // 3600000, t // 60000 % 60, t // 1000 % 60, t % 1000) for t in ms]
+		lines = zip(splitTimeStamps(starts), splitTimeStamps(ends), positions)
+
+	with open(filenameOut, 'w') as f_out:
+		f_out.writelines("%d\n%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d\n%g\n\n" % ((i,) + start + end + (position,))
+		                 for i, (start, end, position) in enumerate(lines, 1))
+
+def convertBinary(filename, indexStep=256, epsilon=0, maxRate=0, streaming=False):
+	filenameOut = os.path.splitext(filename)[0] + '.timeline'
+	print("Compiling \"%s\" to \"%s\"..." % (filename, filenameOut))
+	times, positions = prepare(filename, epsilon, maxRate, streaming)
 
-		srt_timestamp_from = mkSrtTimeStamp(action['at'])
-		srt_timestamp_to = mkSrtTimeStamp(min(action['at'] + actionTimeout*1000, nextAction['at']-10))
-		content = "%g" % (action['pos'] / maxi)
+	if numpy:
+		records = numpy.empty(len(times), dtype=[('at', '<u4'), ('pos', '<f4')])
+		records['at'], records['pos'] = numpy.rint(times), positions
+		index = records['at'][::indexStep].astype('<u4').tobytes()
+		records = records.tobytes()
+	else:
+		index = struct.pack('<%dI' % (len(range(0, len(times), indexStep))), *(int(round(t)) for t in times[::indexStep]))
+		records = b''.join(TIMELINE_RECORD.pack(int(round(t)), p) for t, p in zip(times, positions))
 
-		f_out.write("%d\n%s --> %s\n%s\n\n" % (i, srt_timestamp_from, srt_timestamp_to, content))
-		i+=1
+	recordsOffset = TIMELINE_HEADER.size + len(index)
+	padding = -recordsOffset % 8
+	with open(filenameOut, 'wb') as f_out:
+		f_out.write(TIMELINE_HEADER.pack(TIMELINE_MAGIC, len(times), indexStep, len(index) // 4, recordsOffset + padding))
+		f_out.write(index)
+		f_out.write(b'\0' * padding)
+		f_out.write(records)
+	print("%d actions, %d index entries" % (len(times), len(index) // 4))
 
 def main():
-	if len(sys.argv) <= 1:
-		print("Usage: %s <funscript input files>" % (sys.argv[0]))
-		print("Convert the action and generate output srt files")
-		exit(1)
+	parser = argparse.ArgumentParser(description="Convert the actions of funscripts and generate output srt files. "
+	                                 "The positions are divided by the range of the script (100 by default), the ones out of it are clamped with a warning.")
+	parser.add_argument('filenames', metavar='FILE', nargs='+', help="funscript input files")
+	parser.add_argument('--binary', action='store_true', help="generate binary timelines (.timeline) for mk312-gui.py --funscript instead")
+	parser.add_argument('--epsilon', type=float, default=0, help="simplify the curve, with this max. error on the position (0 to 1, e.g. 0.02)")
+	parser.add_argument('--max-rate', type=float, default=0, help="max. number of actions per second (e.g. 20 for a serial link)")
+	parser.add_argument('--stream', action='store_true', help="parse the files progressively, for huge ones")
+	args = parser.parse_args()
 
-	for filename in sys.argv[1:]:
+	for filename in args.filenames:
 		try:
-			convert(filename)
+			if args.binary:
+				convertBinary(filename, epsilon=args.epsilon, maxRate=args.max_rate, streaming=args.stream)
+			else:
+				convert(filename, epsilon=args.epsilon, maxRate=args.max_rate, streaming=args.stream)
 		except Exception as e:
 			print("Error:", str(e))
 
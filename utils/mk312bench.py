@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Protocol benchmarks of mk312-gui against the emulator (mk312emu.py), with simulated serial and Wi-Fi links.
+# The results are printed (or written) as JSON, so they can be compared between versions.
+
+import os, sys, time, json, socket, argparse, contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mk312emu, mk312core
+
+PROFILES = {
+	'local':  {'transport': 'tcp', 'latency': 0,      'jitter': 0,      'byteTime': 0},
+	'wifi':   {'transport': 'tcp', 'latency': 0.003,  'jitter': 0.002,  'byteTime': 0},
+	'serial': {'transport': 'pty', 'latency': 0.0005, 'jitter': 0,      'byteTime': 10/19200},
+}
+
+def distribution(samples):
+	""" Summary of a list of durations (in seconds), given in milliseconds """
+	if not samples:
+		return {'count': 0}
+	samples = sorted(samples)
+	def percentile(p):
+		return 1000 * samples[min(len(samples)-1, int(p * len(samples)))]
+	return {'count': len(samples), 'mean': 1000 * sum(samples) / len(samples), 'min': 1000 * samples[0],
+	        'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99), 'max': 1000 * samples[-1]}
+
+def rate(function, duration, itemsPerCall=1):
+	count, start = 0, time.time()
+	while time.time() - start < duration:
+		function()
+		count+= itemsPerCall
+	return count / (time.time() - start)
+
+class Bench():
+	def __init__(self, profileName, duration, seed, udpPort):
+		self.profileName = profileName
+		self.profile = PROFILES[profileName]
+		self.duration = duration
+		self.udpPort = udpPort
+		self.emulator = mk312emu.MK312Emulator(seed=seed)
+		lineOptions = {'latency': self.profile['latency'], 'jitter': self.profile['jitter'], 'byteTime': self.profile['byteTime'], 'seed': seed}
+		if self.profile['transport'] == 'tcp':
+			self.portName = '127.0.0.1:%d' % (mk312emu.startTcpServer(self.emulator, **lineOptions))
+		else:
+			self.portName = mk312emu.startPty(self.emulator, **lineOptions)
+
+	def openBox(self, sessionKey=None):
+		if self.profile['transport'] == 'tcp':
+			host, port = self.portName.split(':')
+			return mk312core.MK312(mk312core.NetworkLink(host, int(port)), sessionKey=sessionKey)
+		return mk312core.MK312(mk312core.SerialLink(self.portName), sessionKey=sessionKey)
+
+	def transactions(self):
+		box = self.openBox()
+		addresses = list(range(0x4060, 0x4070))
+		results = {
+			'peek_per_s': rate(lambda: box.peek(0x4064), self.duration),
+			'peek_many_per_s': rate(lambda: box.peekMany(addresses), self.duration, len(addresses)),
+			'poke_per_s': rate(lambda: box.poke(0x4180, [0x20]), self.duration),
+			'poke8_bytes_per_s': rate(lambda: box.poke(0x4180, [0x20] * 8), self.duration, 8),
+		}
+		box.close(resetKey=False)
+		return results
+
+	def reconnect(self):
+		full, resumed = [], []
+		self.emulator.memory[0x4213] = 0
+		for i in range(3):
+			start = time.time()
+			box = self.openBox()
+			full.append(time.time() - start)
+			box.close()
+		box = self.openBox()
+		box.close(resetKey=False)
+		for i in range(3):
+			start = time.time()
+			box = self.openBox(sessionKey=box.encryptionKey)
+			resumed.append(time.time() - start)
+			box.close(resetKey=False)
+		self.emulator.memory[0x4213] = 0
+		return {'full_handshake': distribution(full), 'session_resume': distribution(resumed)}
+
+	def worker(self):
+		worker = mk312core.BoxWorker()
+		worker.pollRate, worker.maxIdleInterval = 1e6, 0 # back to back cycles
+		cycles = []
+		worker.commUpdated.connect(lambda: cycles.append(time.time()))
+
+		start = time.time()
+		worker.open(self.portName)
+		while not cycles:
+			time.sleep(0.001)
+		results = {'open_to_first_cycle_s': cycles[0] - start}
+
+		time.sleep(self.duration)
+		cycleTimes = [b - a for a, b in zip(cycles, cycles[1:])]
+		results['cycle'] = distribution(cycleTimes)
+
+		# remote control: UDP packet -> channel level poke (the same path as the GUI and the daemon)
+		pokes = {}
+		self.emulator.pokeListeners.append(lambda address, data, t: address == 0x4064 and pokes.setdefault(data[0], time.time()))
+		controller = mk312core.BoxController()
+		controller.addBox('main', worker, groups=(controller.remoteGroup,))
+		remoteControl = mk312core.RemoteControl(controller, controller.remoteGroup)
+		remoteControl.setChannel('channel_a_level', 255)
+		udpServer = mk312core.UDPServer(port=self.udpPort)
+		remoteControl.connect(udpServer)
+		sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		latencies = []
+		for i in range(100):
+			value = (i * 37) % 254 + 1
+			pokes.pop(value, None)
+			sent = time.time()
+			sender.sendto(b"%g\n" % (value / 255), ('127.0.0.1', self.udpPort))
+			while value not in pokes and time.time() - sent < 1:
+				time.sleep(0.0002)
+			if value in pokes:
+				latencies.append(pokes[value] - sent)
+			time.sleep(0.005)
+		results['udp_to_poke'] = distribution(latencies)
+		results['udp_lost'] = 100 - len(latencies)
+
+		worker.close()
+		while worker.state != worker.CLOSED:
+			time.sleep(0.01)
+		worker.stop()
+		udpServer.stop()
+		return results
+
+	def run(self):
+		results = self.transactions()
+		results.update(self.reconnect())
+		results.update(self.worker())
+		return results
+
+def main():
+	parser = argparse.ArgumentParser(description="mk312-gui protocol benchmarks")
+	parser.add_argument('profiles', nargs='*', default=list(PROFILES), help="link profiles to run: %s" % (', '.join(PROFILES)))
+	parser.add_argument('--duration', type=float, default=2, help="duration of each throughput measurement (s)")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--udp-port', type=int, default=50000)
+	parser.add_argument('-o', '--output', help="write the JSON results in this file")
+	args = parser.parse_args()
+	for profileName in args.profiles:
+		if profileName not in PROFILES:
+			parser.error("unknown profile: %s" % (profileName))
+
+	# keep the messages of the workers away from the JSON output
+	with contextlib.redirect_stdout(sys.stderr):
+		report = {'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'profiles': {}}
+		for i, profileName in enumerate(args.profiles):
+			print("Running %s..." % (profileName))
+			report['profiles'][profileName] = Bench(profileName, args.duration, args.seed, args.udp_port + i).run()
+
+	output = json.dumps(report, indent=1)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(output + '\n')
+	else:
+		print(output)
+
+
+if __name__ == "__main__":
+	main()
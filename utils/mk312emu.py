@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# MK312 box emulator, speaking the serial protocol of the real box over a pty or a TCP port
+# (like the MK312 Wi-Fi bridge), for testing and measuring mk312-gui without hardware.
+
+import os, time, random, socket, threading, collections, argparse
+
+class MK312Emulator():
+	""" The box itself: memory, encryption state and command parser. Its state survives reconnections, like the real box """
+
+	extraEncryptKey = 0x55
+
+	def __init__(self, execTime=0.002, seed=None):
+		self.execTime = execTime # time the box takes for an execute_command (seconds)
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.memory = bytearray(0x10000)
+		self.lcd = [' '] * 128
+		self.pokeListeners = [] # functions called with (address, data, time) for each write
+		self.executeDoneTime = None
+		self.reset()
+
+	def reset(self):
+		m = self.memory
+		m[0x00fc:0x0100] = bytes((167, 169, 255, 35)) # box_version, v1, v2, v3
+		m[0x4060:0x4066] = bytes((0, 229, 125, 165, 0, 0)) # current_sense, multiadjust, psu, battery, level A, level B
+		m[0x4070], m[0x4071] = 0xff, 0xff
+		m[0x407b] = 0x76 # current_mode: Waves
+		m[0x4086], m[0x4087] = 15, 255 # multiadjust min/max
+		m[0x41f3] = 0x87 # no user modes loaded
+		m[0x41f4] = 2 # power_level_range
+		m[0x41f8:0x4200] = bytes((225, 20, 215, 1, 25, 5, 130, 5)) # advanced parameters
+		m[0x4203] = 210 # battery_voltage_boot
+		m[0x420d] = 229 # multiadjust_scaled
+		m[0x4213] = 0 # com_cipher_key
+		self.lcd = [' '] * 128
+		self.pending = bytearray()
+		self.pendingSince = 0
+
+	def receive(self, data, now=None, plainAllowed=False):
+		""" Feeds the bytes sent by the host, returns the list of replies """
+		now = time.time() if now is None else now
+		replies = []
+		with self.lock:
+			# like the box, give up a packet which is not completed quickly
+			if self.pending and now - self.pendingSince > 0.1:
+				self.pending.clear()
+			if not self.pending:
+				self.pendingSince = now
+			self.pending+= data
+
+			while self.pending:
+				used, reply = self._parse(self.pending, now, plainAllowed)
+				if not used:
+					break
+				del self.pending[:used]
+				self.pendingSince = now
+				if reply is not None:
+					replies.append(bytes(reply))
+		return replies
+
+	def _parse(self, rx, now, plainAllowed):
+		""" Returns (number of bytes used, reply) or (0, None) if the packet is not complete """
+		key = self.memory[0x4213]
+		if rx[0] == 0x00:
+			return 1, [0x07]
+
+		if key == 0 and rx[0] == 0x2f:
+			if len(rx) < 3:
+				return 0, None
+			if plainAllowed and rx[1] == 0x42 and rx[2] == 0x42:
+				return 3, [0x69] # RexLabs Wi-Fi bridge encryptionless mode
+			if (rx[0] + rx[1]) % 256 != rx[2]:
+				return 3, [0x07]
+			# the real box picks a random key, avoid the ones colliding with a command code
+			while True:
+				boxKey = self.random.randrange(256)
+				key = boxKey ^ rx[1] ^ self.extraEncryptKey
+				if key not in (0x00, 0x2f, 0x3c) and key & 0x0f != 0x0d:
+					break
+			self.memory[0x4213] = key
+			return 3, self._reply([0x21, boxKey])
+
+		command = rx[0] ^ key
+		if command == 0x3c:
+			length = 4
+		elif command & 0x0f == 0x0d and 4 <= command >> 4 <= 11:
+			length = (command >> 4) + 1
+		else:
+			return 1, [0x07]
+
+		if len(rx) < length:
+			return 0, None
+		packet = [b ^ key for b in rx[:length]]
+		if sum(packet[:-1]) % 256 != packet[-1]:
+			return length, [0x07]
+
+		address = (packet[1] << 8) | packet[2]
+		if command == 0x3c:
+			self._updateExecution(now)
+			return length, self._reply([0x22, self.memory[address]])
+
+		data = bytes(packet[3:-1])
+		self.memory[address:address+len(data)] = data
+		if address <= 0x4070 < address + len(data):
+			self.executeDoneTime = now + self.execTime
+		for listener in self.pokeListeners:
+			listener(address, data, now)
+		return length, [0x06]
+
+	def _reply(self, data):
+		return data + [sum(data) % 256]
+
+	def _updateExecution(self, now):
+		while self.executeDoneTime is not None and now >= self.executeDoneTime:
+			self._execute(self.memory[0x4070])
+			if self.memory[0x4071] != 0xff:
+				self.memory[0x4070], self.memory[0x4071] = self.memory[0x4071], 0xff
+				self.executeDoneTime+= self.execTime
+			else:
+				self.memory[0x4070] = 0xff
+				self.executeDoneTime = None
+
+	def _execute(self, command):
+		if command == 0x13: # write a character on the LCD
+			self.lcd[self.memory[0x4181] & 0x7f] = chr(self.memory[0x4180])
+		elif command == 0x15: # clear the LCD
+			self.lcd = [' '] * 128
+		elif command == 0x12 and self.memory[0x4078] != 0: # start the mode selected with command 0x04 (or given)
+			self.memory[0x407b] = self.memory[0x4078]
+			self.memory[0x4078] = 0
+
+	def lcdText(self):
+		return ''.join(self.lcd[0:16]) + '\n' + ''.join(self.lcd[64:80])
+
+
+class EmulatedLine():
+	""" Delivers the replies of the emulator like a real link would: with latency, jitter, limited
+	bandwidth and transmission errors. The random generator is seeded so the runs are reproducible. """
+
+	def __init__(self, emulator, write, latency=0, jitter=0, byteTime=0, errorRate=0, dropRate=0, seed=None, plainAllowed=False):
+		self.emulator = emulator
+		self.write = write
+		self.latency, self.jitter, self.byteTime = latency, jitter, byteTime
+		self.errorRate, self.dropRate = errorRate, dropRate
+		self.plainAllowed = plainAllowed
+		self.random = random.Random(seed)
+		self.inputFreeTime, self.outputFreeTime = 0, 0
+		self.queue = collections.deque()
+		self.condition = threading.Condition()
+		self.running = True
+		self.thread = threading.Thread(target=self._sender, name="EmulatedLine sender", daemon=True)
+		self.thread.start()
+
+	def feed(self, data):
+		now = time.time()
+		# the bytes from the host are only complete once they went through the line
+		self.inputFreeTime = max(now, self.inputFreeTime) + self.byteTime * len(data)
+		for reply in self.emulator.receive(data, self.inputFreeTime, self.plainAllowed):
+			reply = bytearray(reply)
+			if self.errorRate and self.random.random() < self.errorRate:
+				reply[self.random.randrange(len(reply))]^= 1 << self.random.randrange(8)
+			if self.dropRate:
+				reply = bytearray(b for b in reply if self.random.random() >= self.dropRate)
+			start = max(self.inputFreeTime + self.latency + self.random.uniform(0, self.jitter), self.outputFreeTime)
+			self.outputFreeTime = start + self.byteTime * len(reply)
+			with self.condition:
+				self.queue.append((self.outputFreeTime, bytes(reply)))
+				self.condition.notify()
+
+	def _sender(self):
+		while True:
+			with self.condition:
+				while self.running and not self.queue:
+					self.condition.wait()
+				if not self.running:
+					return
+				deliveryTime, data = self.queue.popleft()
+			delay = deliveryTime - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			try:
+				if data:
+					self.write(data)
+			except OSError:
+				return
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+
+
+def startTcpServer(emulator, port=0, host='127.0.0.1', plainAllowed=False, **lineOptions):
+	""" Serves the emulator on a TCP port, one client at a time like the Wi-Fi bridge. Returns the port number. """
+	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server.bind((host, port))
+	server.listen(1)
+
+	def serve():
+		while True:
+			client, addr = server.accept()
+			client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			line = EmulatedLine(emulator, client.sendall, plainAllowed=plainAllowed, **lineOptions)
+			try:
+				while True:
+					data = client.recv(1024)
+					if not data:
+						break
+					line.feed(data)
+			except OSError:
+				pass
+			line.stop()
+			client.close()
+
+	threading.Thread(target=serve, name="MK312 emulator TCP server", daemon=True).start()
+	return server.getsockname()[1]
+
+
+def startPty(emulator, **lineOptions):
+	""" Serves the emulator on a pseudo-terminal, returns the device name to open as a serial port """
+	import tty
+	master, slave = os.openpty()
+	tty.setraw(master)
+	tty.setraw(slave)
+	line = EmulatedLine(emulator, lambda data: os.write(master, data), **lineOptions)
+
+	def serve():
+		while True:
+			try:
+				data = os.read(master, 1024)
+			except OSError:
+				# nobody has the port open right now
+				time.sleep(0.05)
+				continue
+			line.feed(data)
+
+	threading.Thread(target=serve, name="MK312 emulator pty", daemon=True).start()
+	return os.ttyname(slave)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="MK312 box emulator")
+	parser.add_argument('--tcp', type=int, metavar='PORT', help="listen on this TCP port (8843 for the unencrypted mode)")
+	parser.add_argument('--plain', action='store_true', help="accept the RexLabs Wi-Fi bridge encryptionless mode on TCP")
+	parser.add_argument('--pty', action='store_true', help="create a pseudo-terminal to use as a serial port")
+	parser.add_argument('--latency', type=float, default=0, help="reply latency (ms)")
+	parser.add_argument('--jitter', type=float, default=0, help="max. random extra latency (ms)")
+	parser.add_argument('--baudrate', type=int, default=0, help="limit the line speed like a serial port (bits/s)")
+	parser.add_argument('--error-rate', type=float, default=0, help="probability of corrupting a reply")
+	parser.add_argument('--drop-rate', type=float, default=0, help="probability of losing a reply byte")
+	parser.add_argument('--exec-time', type=float, default=2, help="duration of the box commands (ms)")
+	parser.add_argument('--seed', type=int, default=None, help="random seed, for reproducible runs")
+	parser.add_argument('-v', '--verbose', action='store_true', help="print the writes and the LCD content")
+	args = parser.parse_args()
+
+	if args.tcp is None and not args.pty:
+		parser.error("at least one of --tcp or --pty is needed")
+
+	emulator = MK312Emulator(execTime=args.exec_time/1000, seed=args.seed)
+	lineOptions = {'latency': args.latency/1000, 'jitter': args.jitter/1000, 'byteTime': 10/args.baudrate if args.baudrate else 0,
+	               'errorRate': args.error_rate, 'dropRate': args.drop_rate, 'seed': args.seed}
+
+	if args.verbose:
+		emulator.pokeListeners.append(lambda address, data, t: print("%.3f poke 0x%04x: %s" % (t, address, data.hex())))
+
+	if args.tcp is not None:
+		port = startTcpServer(emulator, args.tcp, host='0.0.0.0', plainAllowed=args.plain, **lineOptions)
+		print("Listening on TCP port %d" % (port))
+	if args.pty:
+		print("Serial port: %s" % (startPty(emulator, **lineOptions)))
+
+	lcd = None
+	try:
+		while True:
+			time.sleep(0.5)
+			if args.verbose and emulator.lcdText() != lcd:
+				lcd = emulator.lcdText()
+				print(lcd)
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
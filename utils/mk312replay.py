@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Plays again (or dumps) a trace recorded with "mk312-gui.py --trace FILE", without the box.
+
+import os, sys, time, json, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mk312core
+
+def describePacket(packet):
+	""" Names the host commands (decrypted) """
+	if packet[0] == 0x00 and len(packet) == 1:
+		return "hello"
+	if packet[0] == 0x2f:
+		return "key exchange"
+	if packet[0] == 0x3c and len(packet) == 4:
+		return "peek 0x%02x%02x" % (packet[1], packet[2])
+	if packet[0] & 0x0f == 0x0d and len(packet) == (packet[0] >> 4) + 1:
+		return "poke 0x%02x%02x: %s" % (packet[1], packet[2], bytes(packet[3:-1]).hex())
+	return "?"
+
+def dump(path):
+	Trace = mk312core.TraceRecorder
+	start, key = None, None
+	for timestamp, recordType, payload in mk312core.TraceReader(path).records():
+		start = timestamp if start is None else start
+		t = "%10.4f" % (timestamp - start)
+		if recordType == Trace.TX:
+			packet = bytes(b ^ key for b in payload) if key is not None and payload[0] != 0x00 else payload
+			print(t, "TX", payload.hex(), "(%s)" % (describePacket(packet)))
+		elif recordType == Trace.RX:
+			print(t, "RX", payload.hex() if payload else "(nothing)")
+		elif recordType == Trace.KEY:
+			key = payload[0] if payload else None
+			print(t, "KEY", "0x%02x" % (key) if key is not None else "none")
+		elif recordType == Trace.CALL:
+			print(t, "CALL", ' '.join(str(a) for a in json.loads(payload)))
+
+def main():
+	parser = argparse.ArgumentParser(description="MK312 trace replayer")
+	parser.add_argument('trace', help="trace file")
+	parser.add_argument('--dump', action='store_true', help="print the records instead of replaying them")
+	parser.add_argument('--repeat', type=int, default=1, help="replay several times (for profiling)")
+	parser.add_argument('-v', '--verbose', action='store_true', help="print each call and its result")
+	args = parser.parse_args()
+
+	if args.dump:
+		dump(args.trace)
+	else:
+		start = time.time()
+		calls = 0
+		for i in range(args.repeat):
+			calls+= mk312core.replayTrace(args.trace, verbose=args.verbose)
+		elapsed = time.time() - start
+		print("%d calls replayed in %.3fs (%.0f calls/s)" % (calls, elapsed, calls / elapsed if elapsed else 0))
+
+if __name__ == "__main__":
+	main()
@@ -2,29 +2,88 @@
 -- place this script in ~/.config/mpv/scripts/ and get the subtitles content by UDP packets to
 -- synchronise things with video with MPV. Script activation is done by pressing Ctrl+X.
 -- You may need to type "sudo apt-get install lua-socket"
+-- The subtitles are a factor for both channels ("0.5"), or one for each channel ("0.5 0.8").
+-- The position of the video is also sent, for playing funscripts with mk312-gui.py --funscript FILE.
 
 local dest_ip = '127.0.0.1'
 local dest_port = 50000
 
+-- the receiver applies the messages this time (s) after they are sent, to absorb the timing jitter,
+-- so the subtitles are shifted earlier by as much (same as --remote-buffer of mk312-gui.py).
+-- Pausing stops the levels at once: the receiver drops what it still had in its buffer when it gets the position.
+local buffer = 0.1
+
 local utils = require 'mp.utils'
 local socket = require "socket"
 local udp = socket.udp()
 local enabled = false
 local firstEnable = true
+local seq = 0
+local clockSeq = 0
+local savedSubDelay = 0
+
+-- timestamped messages (text version of the v2 remote control protocol)
+local function send(a, b)
+	seq = seq + 1
+	udp:send(string.format("MKR2 %d %.4f %.4f %.4f -\n", seq, socket.gettime(), a, b))
+end
+
+local function sendClock()
+	local position = mp.get_property_number("playback-time")
+	if position ~= nil then
+		local speed = 0
+		if not mp.get_property_native("pause") then
+			speed = mp.get_property_number("speed", 1)
+		end
+		clockSeq = clockSeq + 1
+		udp:send(string.format("MKRT %d %.4f %.4f %.4f\n", clockSeq, socket.gettime(), position, speed))
+	end
+end
+
+local function parseFactors(txt)
+	local a, b = string.match(txt, "^%s*(%d*%.?%d+)%s+(%d*%.?%d+)%s*$")
+	if a == nil then
+		a = string.match(txt, "^%s*(%d*%.?%d+)%s*$")
+		b = a
+	end
+	return tonumber(a), tonumber(b)
+end
 
 mp.observe_property("sub-text","string", function(prop,txt)
 	local playing = not mp.get_property_native("pause")
 	if enabled and playing and txt ~= nil then
-		udp:send(txt.."\n")
+		local a, b = parseFactors(txt)
+		if a ~= nil then
+			send(a, b)
+		else
+			-- no subtitle, or not a level: 0, buffered like the other values
+			send(0, 0)
+		end
 		print(txt)
 	end
 end)
 
 mp.observe_property("pause","bool", function(prop, paused)
 	if enabled and paused then
-		udp:send("\n")
+		send(0, 0)
 		print("paused.")
 	end
+	if enabled then
+		-- while paused, the speed is 0 and the receiver stops without waiting for its buffer
+		sendClock()
+	end
+end)
+
+mp.register_event("playback-restart", function()
+	if enabled then
+		sendClock()
+	end
+end)
+
+mp.add_periodic_timer(0.5, function()
+	if enabled then
+		sendClock()
+	end
 end)
 
 mp.add_key_binding("Ctrl+x","toggle-tts-commands", function()
@@ -41,9 +100,12 @@ mp.add_key_binding("Ctrl+x","toggle-tts-commands", function()
 		mp.set_property_native("sub-color", "#0000FF00")
 		mp.set_property_native("sub-border-color", "#0000FF00")
 		mp.command("no-osd set sub-visibility yes")
+		savedSubDelay = mp.get_property_number("sub-delay", 0)
+		mp.set_property_number("sub-delay", savedSubDelay - buffer)
 	else
 		mp.osd_message("Subtitle to UDP disabled")
 		mp.set_property_native("sub-color", "#FFFFFFFF")
 		mp.set_property_native("sub-border-color", "#FF000000")
+		mp.set_property_number("sub-delay", savedSubDelay)
     end
 end)